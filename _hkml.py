@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: GPL-2.0
 
+import atexit
 import base64
 import datetime
 import email.utils
@@ -12,16 +13,158 @@ import sys
 
 import hkml_cache
 
-def cmd_str_output(cmd):
-    output = subprocess.check_output(cmd)
+def decode_output(output):
     try:
         return output.decode('utf-8').strip()
     except UnicodeDecodeError as e:
         return output.decode('cp437').strip()
 
+def cmd_str_output(cmd):
+    return decode_output(subprocess.check_output(cmd))
+
 def cmd_lines_output(cmd):
     return cmd_str_output(cmd).split('\n')
 
+def cmd_lines_stream(cmd):
+    '''Yields lines of the command output as soon as those are printed.  The
+    command is killed if the caller stops the iteration early.'''
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        for line in proc.stdout:
+            try:
+                yield line.decode('utf-8').rstrip('\n')
+            except UnicodeDecodeError as e:
+                yield line.decode('cp437').rstrip('\n')
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+
+class GitObjectsReader:
+    '''Long-lived 'git cat-file --batch' process for a git directory.
+
+    Object names are written to the process' stdin in chunks, and the contents
+    are read back from the single stdout pipe, so that reading many objects
+    doesn't need a fork and exec of git for each object.'''
+    gitdir = None
+    proc = None
+
+    # Object names written to the pipe before reading back the contents.  The
+    # names of a chunk should fit in the stdin pipe buffer, since git doesn't
+    # read more names while we are not reading the contents.
+    max_names_per_chunk = 512
+
+    def __init__(self, gitdir):
+        self.gitdir = gitdir
+        self.proc = subprocess.Popen(
+                ['git', '--git-dir=%s' % gitdir, 'cat-file', '--batch'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def __read_one(self):
+        header = self.proc.stdout.readline().decode().split()
+        if len(header) != 3:
+            # '<name> missing' or '<name> ambiguous'
+            return None
+        content = self.proc.stdout.read(int(header[2]))
+        # each content is followed by a newline
+        self.proc.stdout.read(1)
+        return content
+
+    def read_objects(self, names):
+        '''Returns a list of contents of the objects in the given order.
+
+        Each content is bytes, or None if the object is not found.'''
+        contents = []
+        for i in range(0, len(names), self.max_names_per_chunk):
+            chunk = names[i:i + self.max_names_per_chunk]
+            self.proc.stdin.write(
+                    ''.join(['%s\n' % name for name in chunk]).encode())
+            self.proc.stdin.flush()
+            for name in chunk:
+                contents.append(self.__read_one())
+        return contents
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+# dict having gitdir as key, GitObjectsReader as value
+git_objects_readers = {}
+
+def get_git_objects_reader(gitdir):
+    if not gitdir in git_objects_readers:
+        git_objects_readers[gitdir] = GitObjectsReader(gitdir)
+    return git_objects_readers[gitdir]
+
+def close_git_objects_readers():
+    for reader in git_objects_readers.values():
+        reader.close()
+    git_objects_readers.clear()
+
+atexit.register(close_git_objects_readers)
+
+# dict having gitdir as key, whether it is a partial clone as value
+partial_clones = {}
+
+def is_partial_clone(gitdir):
+    if not gitdir in partial_clones:
+        partial_clones[gitdir] = False
+        config_path = os.path.join(gitdir, 'config')
+        if os.path.isfile(config_path):
+            with open(config_path, 'r') as f:
+                # 'git clone --filter' marks the remote as a promisor
+                partial_clones[gitdir] = 'promisor = true' in f.read()
+    return partial_clones[gitdir]
+
+def fetch_missing_mboxes(gitdir, gitids):
+    '''Fetch mbox blobs of the commits that missing in a partial clone at
+    once, instead of letting git lazily fetch those one by one'''
+    # '--missing=print' lists missing objects without fetching those
+    output = subprocess.run(
+            ['git', '--git-dir=%s' % gitdir, 'rev-list', '--objects',
+             '--missing=print', '--no-walk', '--stdin'],
+            input='\n'.join(gitids).encode(), stdout=subprocess.PIPE).stdout
+    missing_blobs = [line[1:] for line in decode_output(output).split('\n')
+                     if line.startswith('?')]
+    if not missing_blobs:
+        return
+    subprocess.run(
+            ['git', '-c', 'fetch.negotiationAlgorithm=noop',
+             '--git-dir=%s' % gitdir, 'fetch', '--quiet', 'origin',
+             '--no-tags', '--no-write-fetch-head', '--recurse-submodules=no',
+             '--filter=blob:none', '--stdin'],
+            input='\n'.join(missing_blobs).encode())
+
+# number of mbox blobs read so far, for runtime profiling
+nr_read_mboxes = 0
+
+def read_git_mboxes(gitdir, gitids):
+    '''Returns mbox strings of the public-inbox commits, or None for commits
+    that the mbox cannot be found'''
+    global nr_read_mboxes
+
+    nr_read_mboxes += len(gitids)
+    if is_partial_clone(gitdir) and gitids:
+        fetch_missing_mboxes(gitdir, gitids)
+    contents = get_git_objects_reader(gitdir).read_objects(
+            ['%s:m' % gitid for gitid in gitids])
+    return [decode_output(c) if c is not None else None for c in contents]
+
+def fill_mboxes(mails):
+    '''Read mbox of the git-stored mails not having mbox in a batch'''
+    to_fill = {}
+    for mail in mails:
+        if mail.mbox is not None or not mail.gitdir or not mail.gitid:
+            continue
+        if not mail.gitdir in to_fill:
+            to_fill[mail.gitdir] = []
+        to_fill[mail.gitdir].append(mail)
+    for gitdir, mails_to_fill in to_fill.items():
+        mboxes = read_git_mboxes(gitdir, [m.gitid for m in mails_to_fill])
+        for mail, mbox in zip(mails_to_fill, mboxes):
+            mail.mbox = mbox
+
 class Mail:
     gitid = None
     gitdir = None
@@ -29,10 +172,18 @@ class Mail:
     date = None
     subject_tags = None
     series = None
+    # parsed header fields
     __mbox_parsed = None
+    # whether __mbox_parsed has only a part of header fields
+    __header_partial = False
+    # decoded body.  Decoded only when it is requested
+    __body = None
     mbox = None
     replies = None
     parent_mail = None
+    # thread statistics, set by hkml_list.set_thread_stats()
+    nr_replies = None
+    last_date = None
 
     def set_subject_tags_series(self):
         subject = self.subject
@@ -53,13 +204,26 @@ class Mail:
             self.series = [int(x) for x in series]
 
     @classmethod
-    def from_gitlog(cls, gitid, gitdir, date, subject):
-        mail = hkml_cache.get_mail(gitid, gitdir)
-        if mail != None:
-            return mail
+    def from_gitlog(cls, gitid, gitdir, date, subject, mbox=None,
+                    header=None, author=None, check_cache=True):
+        # callers that already looked up the cache can skip it
+        if check_cache:
+            mail = hkml_cache.get_mail(gitid, gitdir)
+            if mail != None:
+                return mail
         self = cls()
         self.gitid = gitid
         self.gitdir = gitdir
+        self.mbox = mbox
+        if header is None and mbox is None and author is not None:
+            # public-inbox commits have the sender as the author
+            header = {}
+        if header is not None:
+            # e.g., from hkml_index.  mbox is read only if really needed.
+            self.__mbox_parsed = header
+            self.__header_partial = True
+            if header.get('from') is None and author is not None:
+                self.__mbox_parsed['from'] = author
         try:
             self.date = datetime.datetime.fromisoformat(date).astimezone()
         except:
@@ -89,6 +253,10 @@ class Mail:
             self.gitdir = kvpairs['gitdir']
             self.subject = kvpairs['subject']
             self.mbox = kvpairs['mbox']
+            if 'header' in kvpairs:
+                self.__set_parsed_kvpairs(kvpairs)
+                hkml_cache.set_mail(self)
+                return
 
         self.__parse_mbox()
         date_str = self.get_field('date')
@@ -104,18 +272,48 @@ class Mail:
         self.set_subject_tags_series()
         hkml_cache.set_mail(self)
 
+    def __set_parsed_kvpairs(self, kvpairs):
+        '''Set fields from to_kvpairs() output without parsing mbox'''
+        self.__mbox_parsed = kvpairs['header']
+        self.__header_partial = kvpairs.get('header_partial', False)
+        if kvpairs['date_epoch'] is None:
+            self.date = None
+            return
+        self.date = datetime.datetime.fromtimestamp(
+                kvpairs['date_epoch']).astimezone()
+        if not self.subject:
+            self.subject = self.__mbox_parsed.get('subject')
+        self.subject_tags = kvpairs['subject_tags']
+        self.series = kvpairs['series']
+
     def broken(self):
         return self.date is None or self.subject is None
 
     def to_kvpairs(self):
-        if self.mbox == None:
-            # ensure mbox is set.  TODO: don't parse it unnecessarily
-            self.get_field('message-id')
+        if not self.__mbox_parsed:
+            # ensure mbox is set and header is parsed
+            self.__parse_mbox()
+        date_epoch = None
+        date_str = self.__mbox_parsed.get('date')
+        if date_str is not None:
+            try:
+                date_epoch = email.utils.mktime_tz(
+                        email.utils.parsedate_tz(date_str))
+            except:
+                date_epoch = None
+        if date_epoch is None and self.date is not None:
+            # no or broken 'Date:' header.  Use the git log date.
+            date_epoch = int(self.date.timestamp())
         return {
                 'gitid': self.gitid,
                 'gitdir': self.gitdir,
                 'subject': self.subject,
-                'mbox': self.mbox}
+                'mbox': self.mbox,
+                'header': self.__mbox_parsed,
+                'header_partial': self.__header_partial,
+                'date_epoch': date_epoch,
+                'subject_tags': self.subject_tags,
+                'series': self.series}
 
     def get_field(self, tag):
         tag = tag.lower()
@@ -126,22 +324,21 @@ class Mail:
         if not self.__mbox_parsed:
             self.__parse_mbox()
 
+        if tag == 'body':
+            if self.__body is None:
+                self.__parse_body()
+            return self.__body
+
+        if not tag in self.__mbox_parsed and self.__header_partial:
+            self.__parse_mbox()
         if not tag in self.__mbox_parsed:
             return None
         return self.__mbox_parsed[tag]
 
-    def __parse_mbox(self):
-        if not self.mbox:
-            if not self.gitdir or not self.gitid:
-                print('cannot get mbox')
-                exit(1)
-            cmd = ['git', '--git-dir=%s' % self.gitdir,
-                    'show', '%s:m' % self.gitid]
-            self.mbox = cmd_str_output(cmd)
-
+    def __parse_header(self, mbox_lines):
+        '''Returns parsed header fields and the index of the body start line'''
         in_header = True
         parsed = {}
-        mbox_lines = self.mbox.split('\n')
         for idx, line in enumerate(mbox_lines):
             if in_header:
                 if line and line[0] in [' ', '\t'] and key:
@@ -159,23 +356,46 @@ class Mail:
                     in_header = False
                 continue
             break
+        return parsed, idx
+
+    def __parse_body(self):
+        if not self.mbox:
+            self.__read_mbox()
         try:
             # 'm' doesn't have start 'From' line in some case.  Add a fake one.
             mbox_str = '\n'.join(['From mboxrd@z Thu Jan  1 00:00:00 1970',
                 self.mbox])
-            parsed['body'] = mailbox.Message(
+            self.__body = mailbox.Message(
                     mbox_str).get_payload(decode=True).decode()
         except:
             # Still decode() could fail due to encoding
-            parsed['body'] = '\n'.join(mbox_lines[idx:])
+            mbox_lines = self.mbox.split('\n')
+            body_start_idx = self.__parse_header(mbox_lines)[1]
+            self.__body = '\n'.join(mbox_lines[body_start_idx:])
 
             encoding_key = 'Content-Transfer-Encoding'.lower()
+            parsed = self.__mbox_parsed
             if encoding_key in parsed and parsed[encoding_key] == 'base64':
                 try:
-                    parsed['body'] = base64.b64decode(parsed['body']).decode()
+                    self.__body = base64.b64decode(self.__body).decode()
                 except:
                     pass
 
+    def __read_mbox(self):
+        if not self.gitdir or not self.gitid:
+            print('cannot get mbox')
+            exit(1)
+        self.mbox = read_git_mboxes(self.gitdir, [self.gitid])[0]
+        if self.mbox is None:
+            print('cannot get mbox of %s' % self.gitid)
+            exit(1)
+
+    def __parse_mbox(self):
+        if not self.mbox:
+            self.__read_mbox()
+
+        parsed = self.__parse_header(self.mbox.split('\n'))[0]
+
         # for lore-pasted string case
         if 'date' in parsed:
             tokens = parsed['date'].split()
@@ -183,6 +403,7 @@ class Mail:
                 parsed['date'] = ' '.join(tokens[:-2])
 
         self.__mbox_parsed = parsed
+        self.__header_partial = False
 
 def read_mbox_file(filepath):
     mails = []
@@ -211,6 +432,7 @@ def read_mails_from_clipboard():
 
 __hkml_dir = None
 __manifest = None
+__manifest_file = None
 
 def set_hkml_dir(path=None):
     global __hkml_dir
@@ -250,24 +472,43 @@ def get_hkml_dir():
 
 def set_hkml_dir_manifest(hkml_dir, manifest):
     global __manifest
+    global __manifest_file
 
     set_hkml_dir(hkml_dir)
     if manifest is None:
         manifest = os.path.join(get_hkml_dir(), 'manifest')
+    __manifest_file = manifest
+    __manifest = None
+
+def get_manifest():
+    '''Returns the manifest, loading it from the file at the first call'''
+    global __manifest
 
+    if __manifest is not None:
+        return __manifest
+    if __manifest_file is None:
+        sys.stderr.write('BUG: Manifest file is not set\n')
+        exit(1)
     try:
-        with open(manifest, 'r') as f:
+        with open(__manifest_file, 'r') as f:
             __manifest = json.load(f)
     except:
-        sys.stderr.write('Manifest (%s) load failed\n' % manifest)
-        exit(1)
-
-def get_manifest():
-    if __manifest is None:
-        sys.stderr.write('BUG: Manifest file is not set\n')
+        sys.stderr.write('Manifest (%s) load failed\n' % __manifest_file)
         exit(1)
     return __manifest
 
+def update_manifest(manifest):
+    '''Replace the manifest and the default manifest file under the hkml
+    directory with the given one.  Manifest files that users specified via
+    --manifest are not overwritten.'''
+    global __manifest
+    global __manifest_file
+
+    __manifest_file = os.path.join(get_hkml_dir(), 'manifest')
+    with open(__manifest_file, 'w') as f:
+        json.dump(manifest, f)
+    __manifest = manifest
+
 def __get_epoch_from_git_path(git_path):
     # git_path is, e.g., '.../0.git'
     return int(os.path.basename(git_path).split('.git')[0])
@@ -2,8 +2,11 @@
 
 import argparse
 import datetime
+import hashlib
 import json
 import os
+import sqlite3
+import struct
 import time
 
 import _hkml
@@ -13,6 +16,16 @@ import _hkml
 # archieved cache: Contains cache entries that added older than oldest one in
 # the active cache.
 #
+# Each cache file is a sequence of records, one per line.  Each record is a
+# json list of the key and the value of a cache entry.  New entries are
+# appended to the active cache file, so writing back the cache costs only the
+# new entries.  A record that not ended with a newline is a partially written
+# one, and ignored.  The active cache file is compacted, i.e., rewritten to a
+# temporary file having only the valid and unique records and then renamed to
+# the active cache file, when such records are found.  Cache files of old
+# format, a json dict of all entries, can also be read, and the active one is
+# compacted into the new format.
+#
 # Size of cache files are limited to about 100 MiB by default.
 # Up to 9 archived cache files can exist by default.
 # When the size of active cache becomes >=100 MiB, delete oldest archived
@@ -20,31 +33,190 @@ import _hkml
 # cache.
 #
 # When reading the cache, active cache is first read, then archived caches one
-# by one, recent archive first, until the item is found.
+# by one, recent archive first, until the item is found.  Each archived cache
+# has a keys filter file (mails_cache_keys_filter_<timestamp>), which is used
+# to skip loading archives that surely not having the item.
+#
+# Above is for the default 'json' backend.  Users can alternatively use
+# 'sqlite' backend, which saves all the entries in a single SQLite database
+# file, 'mails_cache.db', and reads only the entries that really needed.  The
+# database is allowed to grow up to the total size of the json backend files,
+# i.e., max_active_cache_sz * (1 + max_archived_caches).  When it exceeds the
+# size, oldest entries are evicted first.
+
+cache_config = None
 
 def load_cache_config():
-    cache_config_path = os.path.join(_hkml.get_hkml_dir(),
-                                     'mails_cache_config')
-    if not os.path.isfile(cache_config_path):
-        return {'max_active_cache_sz': 100 * 1024 * 1024,
-                'max_archived_caches': 9}
+    global cache_config
 
-    with open(cache_config_path, 'r') as f:
-        return json.load(f)
+    if cache_config is not None:
+        return cache_config
 
-def set_cache_config(max_active_cache_sz, max_archived_caches):
+    cache_config = {'max_active_cache_sz': 100 * 1024 * 1024,
+                    'max_archived_caches': 9,
+                    'backend': 'json'}
+    cache_config_path = os.path.join(_hkml.get_hkml_dir(),
+                                     'mails_cache_config')
+    if os.path.isfile(cache_config_path):
+        with open(cache_config_path, 'r') as f:
+            cache_config.update(json.load(f))
+    return cache_config
+
+def set_cache_config(max_active_cache_sz, max_archived_caches, backend=None):
+    if backend is None:
+        # keep the currently configured backend
+        backend = load_cache_config()['backend']
     cache_config_path = os.path.join(_hkml.get_hkml_dir(),
                                      'mails_cache_config')
     with open(cache_config_path, 'w') as f:
         json.dump({'max_active_cache_sz': max_active_cache_sz,
-                   'max_archived_caches': max_archived_caches}, f, indent=4)
+                   'max_archived_caches': max_archived_caches,
+                   'backend': backend}, f, indent=4)
+
+def use_sqlite_backend():
+    return load_cache_config()['backend'] == 'sqlite'
+
+def sqlite_cache_path():
+    return os.path.join(_hkml.get_hkml_dir(), 'mails_cache.db')
+
+# connection to the sqlite backend database
+sqlite_cache = None
+sqlite_cache_version = 1
+
+# dict having cache key as key, Mail kvpairs as value.  Entries that set but
+# not yet written back to the sqlite backend database.
+sqlite_cache_pending = {}
+
+def get_sqlite_cache():
+    global sqlite_cache
+
+    if sqlite_cache is not None:
+        return sqlite_cache
+
+    sqlite_cache = sqlite3.connect(sqlite_cache_path())
+    db = sqlite_cache
+    if db.execute('PRAGMA user_version').fetchone()[0] != \
+            sqlite_cache_version:
+        # keep entries of older format, in the eviction order
+        with db:
+            db.execute('DROP TABLE IF EXISTS meta')
+            db.execute('DROP TRIGGER IF EXISTS mails_insert')
+            db.execute('DROP TRIGGER IF EXISTS mails_delete')
+            if db.execute(
+                    """SELECT 1 FROM sqlite_master
+                    WHERE type = 'table' AND name = 'mails'""").fetchone():
+                db.execute('ALTER TABLE mails RENAME TO old_mails')
+            create_sqlite_cache_tables(db)
+            if db.execute(
+                    """SELECT 1 FROM sqlite_master
+                    WHERE type = 'table' AND name = 'old_mails'""").fetchone():
+                db.execute(
+                        """INSERT INTO mails (key, size, kvpairs)
+                        SELECT key, size, kvpairs FROM old_mails
+                        ORDER BY rowid""")
+                db.execute('DROP TABLE old_mails')
+            db.execute('PRAGMA user_version = %d' % sqlite_cache_version)
+    return sqlite_cache
+
+def create_sqlite_cache_tables(db):
+    # 'size' is before 'kvpairs', to be read without the overflow pages of
+    # 'kvpairs'.  'meta' table has the total size of the entries, which the
+    # triggers keep updated.
+    db.execute(
+            '''CREATE TABLE mails (
+                key TEXT PRIMARY KEY, size INTEGER NOT NULL,
+                kvpairs TEXT NOT NULL)''')
+    db.execute(
+            '''CREATE TABLE meta (
+                key TEXT PRIMARY KEY, value INTEGER NOT NULL)''')
+    db.execute("INSERT INTO meta VALUES ('total_size', 0)")
+    db.execute(
+            '''CREATE TRIGGER mails_insert AFTER INSERT ON mails BEGIN
+                UPDATE meta SET value = value + NEW.size
+                WHERE key = 'total_size'; END''')
+    db.execute(
+            '''CREATE TRIGGER mails_delete AFTER DELETE ON mails BEGIN
+                UPDATE meta SET value = value - OLD.size
+                WHERE key = 'total_size'; END''')
+
+def sqlite_get_kvpairs(key):
+    if key in sqlite_cache_pending:
+        return sqlite_cache_pending[key]
+    row = get_sqlite_cache().execute(
+            'SELECT kvpairs FROM mails WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+def sqlite_has_key(key):
+    if key in sqlite_cache_pending:
+        return True
+    return get_sqlite_cache().execute(
+            'SELECT 1 FROM mails WHERE key = ?', (key,)).fetchone() is not None
+
+def sqlite_evict_old_mails(db):
+    config = load_cache_config()
+    max_sz = config['max_active_cache_sz'] * (
+            1 + config['max_archived_caches'])
+    total_sz = db.execute(
+            "SELECT value FROM meta WHERE key = 'total_size'").fetchone()[0]
+    while total_sz > max_sz:
+        rows = db.execute(
+                'SELECT rowid, size FROM mails ORDER BY rowid LIMIT 1024')
+        rowids = []
+        for rowid, size in rows.fetchall():
+            if total_sz <= max_sz:
+                break
+            rowids.append((rowid,))
+            total_sz -= size
+        if not rowids:
+            break
+        db.executemany('DELETE FROM mails WHERE rowid = ?', rowids)
+
+def sqlite_insert_kvpairs(db, kvpairs_map):
+    '''Insert the cache entries, oldest first, in one transaction'''
+    rows = []
+    for key, kvpairs in kvpairs_map.items():
+        value = json.dumps(kvpairs)
+        rows.append((key, len(value), value))
+    with db:
+        db.executemany(
+                'INSERT OR IGNORE INTO mails VALUES (?, ?, ?)', rows)
+        sqlite_evict_old_mails(db)
+
+def sqlite_writeback_mails():
+    if not sqlite_cache_pending:
+        return
+    sqlite_insert_kvpairs(get_sqlite_cache(), sqlite_cache_pending)
+    sqlite_cache_pending.clear()
+
+def migrate_json_to_sqlite(keep_json):
+    '''Move json backend cache entries to the sqlite backend database'''
+    active_path = os.path.join(_hkml.get_hkml_dir(), 'mails_cache_active')
+    # oldest first, to keep the eviction order
+    json_paths = list(reversed(list_archive_files()))
+    if os.path.isfile(active_path):
+        json_paths.append(active_path)
+
+    db = get_sqlite_cache()
+    for json_path in json_paths:
+        cache = load_cache_file(json_path)[0]
+        sqlite_insert_kvpairs(db, cache)
+        print('%d mails of %s migrated' % (len(cache), json_path))
+        if not keep_json:
+            if json_path == active_path:
+                os.remove(json_path)
+            else:
+                remove_archive_file(json_path)
 
 # dict having gitid/gitdir as key, Mail kvpairs as value
 
-archived_caches = []
+# dict having archive file path as key, the loaded archived cache as value
+archived_caches = {}
 active_cache = None
 
-need_file_update = False
+# keys of active cache entries that not yet appended to the active cache file
+active_cache_new_keys = []
 
 def get_cache_key(gitid=None, gitdir=None, msgid=None):
     if gitid is not None:
@@ -62,6 +234,124 @@ def list_archive_files():
     archive_files.sort(reverse=True)
     return archive_files
 
+class CacheKeysFilter:
+    '''Bloom filter of the keys in an archived cache.
+
+    It is saved next to the archived cache file, and used for answering
+    whether a key is not in the archived cache without loading the archive.
+    Archived caches are never updated, so the filter is built only once.'''
+    nr_bits = None
+    nr_hashes = None
+    bits = None
+
+    # false positive rate of about 1%
+    bits_per_key = 10
+    default_nr_hashes = 7
+
+    def __init__(self, keys=None, filter_bytes=None):
+        if filter_bytes is not None:
+            self.nr_bits, self.nr_hashes = struct.unpack(
+                    '<II', filter_bytes[:8])
+            self.bits = bytearray(filter_bytes[8:])
+            return
+
+        self.nr_bits = max(len(keys) * self.bits_per_key, 64)
+        self.nr_hashes = self.default_nr_hashes
+        self.bits = bytearray((self.nr_bits + 7) // 8)
+        for key in keys:
+            for idx in self.bit_indices(key):
+                self.bits[idx // 8] |= 1 << (idx % 8)
+
+    def bit_indices(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        hash1 = int.from_bytes(digest[:8], 'little')
+        hash2 = int.from_bytes(digest[8:], 'little')
+        return [(hash1 + i * hash2) % self.nr_bits
+                for i in range(self.nr_hashes)]
+
+    def may_contain(self, key):
+        for idx in self.bit_indices(key):
+            if not self.bits[idx // 8] & (1 << (idx % 8)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return struct.pack('<II', self.nr_bits, self.nr_hashes) + self.bits
+
+def keys_filter_path(archive_path):
+    # archive_path is .../mails_cache_archive_<timestamp>
+    dirname, basename = os.path.split(archive_path)
+    return os.path.join(dirname, basename.replace(
+        'mails_cache_archive_', 'mails_cache_keys_filter_'))
+
+# dict having archive file path as key, CacheKeysFilter of it as value
+keys_filters = {}
+
+def get_keys_filter(archive_path):
+    '''Returns CacheKeysFilter of the archive, or None if not yet built'''
+    if archive_path in keys_filters:
+        return keys_filters[archive_path]
+
+    filter_path = keys_filter_path(archive_path)
+    if not os.path.isfile(filter_path):
+        return None
+    with open(filter_path, 'rb') as f:
+        keys_filters[archive_path] = CacheKeysFilter(filter_bytes=f.read())
+    return keys_filters[archive_path]
+
+def build_keys_filter(archive_path, archived_cache):
+    keys_filter = CacheKeysFilter(keys=archived_cache.keys())
+    # write to a temporary file first, to not leave a broken filter
+    filter_path = keys_filter_path(archive_path)
+    with open(filter_path + '.tmp', 'wb') as f:
+        f.write(keys_filter.to_bytes())
+    os.rename(filter_path + '.tmp', filter_path)
+    keys_filters[archive_path] = keys_filter
+
+def remove_archive_file(archive_path):
+    os.remove(archive_path)
+    filter_path = keys_filter_path(archive_path)
+    if os.path.isfile(filter_path):
+        os.remove(filter_path)
+
+def cache_record(key, kvpairs):
+    return '%s\n' % json.dumps([key, kvpairs])
+
+def load_cache_file(cache_path):
+    '''Returns the cache in the file, and whether the file need compaction'''
+    with open(cache_path, 'r') as f:
+        content = f.read()
+    if content.startswith('{'):
+        # old format cache file
+        return json.loads(content), True
+
+    cache = {}
+    need_compaction = False
+    records = content.split('\n')
+    # the last one should be an empty string, unless partially written
+    if records[-1] != '':
+        need_compaction = True
+    for record in records[:-1]:
+        try:
+            key, kvpairs = json.loads(record)
+        except:
+            need_compaction = True
+            continue
+        if key in cache:
+            need_compaction = True
+        cache[key] = kvpairs
+    return cache, need_compaction
+
+def compact_cache_file(cache_path, cache):
+    tmp_path = '%s.tmp' % cache_path
+    with open(tmp_path, 'w') as f:
+        for key, kvpairs in cache.items():
+            f.write(cache_record(key, kvpairs))
+        f.flush()
+        os.fsync(f.fileno())
+    # the rename is atomic, so a crash leaves either old or new file
+    os.replace(tmp_path, cache_path)
+
 def get_active_mails_cache():
     global active_cache
 
@@ -73,70 +363,95 @@ def get_active_mails_cache():
     if os.path.isfile(cache_path):
         stat = os.stat(cache_path)
         if stat.st_size >= load_cache_config()['max_active_cache_sz']:
+            # keys filter of the new archive is built when it is first loaded
             os.rename(
                     cache_path, os.path.join(
                         _hkml.get_hkml_dir(), 'mails_cache_archive_%s' %
                         datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')))
             archive_files = list_archive_files()
             if len(archive_files) > load_cache_config()['max_archived_caches']:
-                os.remove(archive_files[-1])
+                remove_archive_file(archive_files[-1])
         else:
-            with open(cache_path, 'r') as f:
-                active_cache = json.load(f)
+            active_cache, need_compaction = load_cache_file(cache_path)
+            if need_compaction:
+                compact_cache_file(cache_path, active_cache)
     return active_cache
 
-def load_one_more_archived_cache():
-    global archived_caches
+def load_archived_cache(archive_path):
+    archived_caches[archive_path] = load_cache_file(archive_path)[0]
+    if get_keys_filter(archive_path) is None:
+        build_keys_filter(archive_path, archived_caches[archive_path])
+    return archived_caches[archive_path]
 
-    archive_files = list_archive_files()
-    if len(archive_files) == len(archived_caches):
-        return False
-    with open(archive_files[len(archived_caches)], 'r') as f:
-        archived_caches.append(json.load(f))
-    return True
+def get_archived_kvpairs(key):
+    '''Find the key from archived caches, recent archive first.
 
-def get_mail(gitid=None, gitdir=None, key=None):
-    global archived_caches
+    Archives that the keys filter says not having the key are not loaded.'''
+    for archive_path in list_archive_files():
+        if archive_path in archived_caches:
+            cache = archived_caches[archive_path]
+        else:
+            keys_filter = get_keys_filter(archive_path)
+            if keys_filter is not None and not keys_filter.may_contain(key):
+                continue
+            cache = load_archived_cache(archive_path)
+        if key in cache:
+            return cache[key]
+    return None
 
+def get_mail(gitid=None, gitdir=None, key=None):
     if key is None:
         key = get_cache_key(gitid, gitdir)
 
+    if use_sqlite_backend():
+        kvpairs = sqlite_get_kvpairs(key)
+        if kvpairs is None:
+            return None
+        return _hkml.Mail(kvpairs=kvpairs)
+
     cache = get_active_mails_cache()
     if key in cache:
         return _hkml.Mail(kvpairs=cache[key])
-    for cache in archived_caches:
-        if key in cache:
-            return _hkml.Mail(kvpairs=cache[key])
-    while load_one_more_archived_cache() == True:
-        if key in archived_caches[-1]:
-            return _hkml.Mail(kvpairs=archived_caches[-1][key])
-    return None
+    kvpairs = get_archived_kvpairs(key)
+    if kvpairs is None:
+        return None
+    return _hkml.Mail(kvpairs=kvpairs)
 
 def set_mail(mail):
-    global need_file_update
-
     if mail.broken():
         return
 
-    cache = get_active_mails_cache()
     if mail.gitid is not None and mail.gitdir is not None:
         key = get_cache_key(mail.gitid, mail.gitdir)
     else:
         key = mail.get_field('message-id')
+
+    if use_sqlite_backend():
+        if not sqlite_has_key(key):
+            sqlite_cache_pending[key] = mail.to_kvpairs()
+        return
+
+    cache = get_active_mails_cache()
     if key in cache:
         return
-    for archived_cache in archived_caches:
+    for archived_cache in archived_caches.values():
         if key in archived_cache:
             return
     cache[key] = mail.to_kvpairs()
-    need_file_update = True
+    active_cache_new_keys.append(key)
 
 def writeback_mails():
-    if not need_file_update:
+    if use_sqlite_backend():
+        sqlite_writeback_mails()
+        return
+    if not active_cache_new_keys:
         return
+    cache = get_active_mails_cache()
     cache_path = os.path.join(_hkml.get_hkml_dir(), 'mails_cache_active')
-    with open(cache_path, 'w') as f:
-        json.dump(get_active_mails_cache(), f, indent=4)
+    with open(cache_path, 'a') as f:
+        f.write(''.join([cache_record(key, cache[key])
+                         for key in active_cache_new_keys]))
+    active_cache_new_keys.clear()
 
 def pr_cache_stat(cache_path, profile_mail_parsing_time):
     print('Stat of %s' % cache_path)
@@ -144,8 +459,7 @@ def pr_cache_stat(cache_path, profile_mail_parsing_time):
     print('cache size: %.3f MiB' % (cache_stat.st_size / 1024 / 1024))
 
     before_timestamp = time.time()
-    with open(cache_path, 'r') as f:
-        cache = json.load(f)
+    cache = load_cache_file(cache_path)[0]
     print('%d mails in cache' % len(cache))
     print('%f seconds for json-loading cache' %
           (time.time() - before_timestamp))
@@ -157,8 +471,26 @@ def pr_cache_stat(cache_path, profile_mail_parsing_time):
         mail = _hkml.Mail(kvpairs=cache[key])
     print('%f seconds for parsing mails' % (time.time() - before_timestamp))
 
+def pr_sqlite_cache_stat(profile_mail_parsing_time):
+    cache_path = sqlite_cache_path()
+    print('Stat of %s' % cache_path)
+    cache_stat = os.stat(cache_path)
+    print('cache size: %.3f MiB' % (cache_stat.st_size / 1024 / 1024))
+
+    db = get_sqlite_cache()
+    print('%d mails in cache' %
+          db.execute('SELECT COUNT(*) FROM mails').fetchone()[0])
+
+    if profile_mail_parsing_time is not True:
+        return
+    before_timestamp = time.time()
+    for row in db.execute('SELECT kvpairs FROM mails'):
+        mail = _hkml.Mail(kvpairs=json.loads(row[0]))
+    print('%f seconds for parsing mails' % (time.time() - before_timestamp))
+
 def show_cache_status(config_only, profile_mail_parsing_time):
     cache_config = load_cache_config()
+    print('backend: %s' % cache_config['backend'])
     print('max active cache file size: %s bytes' %
           cache_config['max_active_cache_sz'])
     print('max archived caches: %d' % cache_config['max_archived_caches'])
@@ -166,6 +498,13 @@ def show_cache_status(config_only, profile_mail_parsing_time):
         return
     print()
 
+    if use_sqlite_backend():
+        if not os.path.isfile(sqlite_cache_path()):
+            print('no cache exist')
+            exit(1)
+        pr_sqlite_cache_stat(profile_mail_parsing_time)
+        return
+
     cache_path = os.path.join(_hkml.get_hkml_dir(), 'mails_cache_active')
     if not os.path.isfile(cache_path):
         print('no cache exist')
@@ -181,7 +520,13 @@ def main(args):
     if args.action == 'status':
         show_cache_status(args.config_only, args.profile_mail_parsing_time)
     elif args.action == 'config':
-        set_cache_config(args.max_active_cache_sz, args.max_archived_caches)
+        set_cache_config(args.max_active_cache_sz, args.max_archived_caches,
+                         args.backend)
+    elif args.action == 'migrate':
+        if not use_sqlite_backend():
+            print('backend is not sqlite.  Set it via \'hkml cache config\'')
+            exit(1)
+        migrate_json_to_sqlite(args.keep_json)
 
 def set_argparser(parser):
     parser.description = 'manage mails cache'
@@ -204,3 +549,12 @@ def set_argparser(parser):
     parser_config.add_argument(
             'max_archived_caches', type=int, metavar='<int>',
             help='maximum number of archived caches')
+    parser_config.add_argument(
+            '--backend', choices=['json', 'sqlite'],
+            help='cache storage backend (default: keep current, or json)')
+
+    parser_migrate = subparsers.add_parser(
+            'migrate', help='move json backend cache to sqlite backend')
+    parser_migrate.add_argument(
+            '--keep_json', action='store_true',
+            help='do not remove the json backend cache files')
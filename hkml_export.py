@@ -7,6 +7,7 @@ import _hkml
 import hkml_list
 
 def export_mails(mails, export_file):
+    _hkml.fill_mboxes(mails)
     if export_file[-5:] != '.mbox':
         with open(export_file, 'w') as f:
             json.dump([m.to_kvpairs() for m in mails], f, indent=4)
@@ -14,8 +15,6 @@ def export_mails(mails, export_file):
 
     with open(export_file, 'w') as f:
         for mail in mails:
-            if mail.mbox is None:
-                mail.get_field('message-id')
             f.write('\n'.join(
                 ['From mboxrd@z Thu Jan  1 00:00:00 1970', mail.mbox,'']))
 
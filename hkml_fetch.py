@@ -2,35 +2,154 @@
 # SPDX-License-Identifier: GPL-2.0
 
 import argparse
+import concurrent.futures
+import datetime
+import json
 import os
 import subprocess
+import threading
+import time
 
 import _hkml
-import hkml_list
+import hkml_index
+import hkml_maintain
+import hkml_manifest
 
-def fetch_mail(mail_lists, quiet=False, epochs=1):
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file_ in files:
+            size += os.path.getsize(os.path.join(root, file_))
+    return size
+
+# lock for printing outputs of concurrent git commands
+pr_lock = threading.Lock()
+
+def fetch_repo(cmd, local_path, name, quiet):
+    '''Run the git command for fetching a repo, print its output with the repo
+    name prefix, and returns the return code, seconds and bytes it took'''
+    size_before = dir_size(local_path)
+    start_time = time.time()
+    proc = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output_lines = []
+    for line in proc.stdout:
+        line = '[%s] %s' % (name, line.decode(errors='replace').rstrip())
+        if quiet:
+            output_lines.append(line)
+            continue
+        with pr_lock:
+            print(line)
+    rc = proc.wait()
+    if rc == 0:
+        # keep 'git log' of 'hkml list' fast for the new commits
+        hkml_maintain.write_commit_graph(local_path, incremental=True)
+    if rc != 0 and quiet:
+        # show what happened at least for failures
+        with pr_lock:
+            print('\n'.join(output_lines))
+    return rc, time.time() - start_time, dir_size(local_path) - size_before
+
+'''
+Fingerprints of the repositories that last fetched, are saved in a json file
+called 'fetched_fingerprints' under the hkml directory.  Keys are the paths of
+the repositories in the manifest, and values are the manifest's 'fingerprint'
+of the repositories at the time of the fetch.
+'''
+
+def fingerprints_file_path():
+    return os.path.join(_hkml.get_hkml_dir(), 'fetched_fingerprints')
+
+def read_fingerprints():
+    if not os.path.isfile(fingerprints_file_path()):
+        return {}
+    with open(fingerprints_file_path(), 'r') as f:
+        return json.load(f)
+
+def write_fingerprints(fingerprints):
+    with open(fingerprints_file_path(), 'w') as f:
+        json.dump(fingerprints, f, indent=4)
+
+def modified_before(repo, date_str):
+    '''Returns whether the manifest entry of the repo says it is last modified
+    before the date'''
+    try:
+        date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+    except ValueError:
+        # git understands more formats.  Just assume it is not.
+        return False
+    if not 'modified' in repo:
+        return False
+    return repo['modified'] < date.timestamp()
+
+def fetch_mail(mail_lists, quiet=False, epochs=1, jobs=1,
+               skip_unchanged=False, update_manifest=False,
+               filter_blobs=False, shallow_since=None):
     manifest = _hkml.get_manifest()
 
     site = manifest['site']
+    if update_manifest:
+        manifest = hkml_manifest.fetch_public_inbox_manifest(site)
+        _hkml.update_manifest(manifest)
+
+    fingerprints = read_fingerprints()
+    repos = []
     for mlist in mail_lists:
-        hkml_list.invalidate_cached_outputs(mlist)
         repo_paths = _hkml.mail_list_repo_paths(mlist, manifest)[:epochs]
         local_paths = _hkml.mail_list_data_paths(mlist, manifest)[:epochs]
 
         for idx, repo_path in enumerate(repo_paths):
             git_url = '%s%s' % (site, repo_path)
             local_path = local_paths[idx]
+            fingerprint = manifest[repo_path].get('fingerprint')
             if not os.path.isdir(local_path):
+                if (shallow_since is not None and
+                        modified_before(manifest[repo_path], shallow_since)):
+                    # shallow clone of no commit fails
+                    if not quiet:
+                        print('skip %s having no mail since %s' %
+                              (repo_path[1:], shallow_since))
+                    continue
                 cmd = 'git clone --mirror %s %s' % (git_url, local_path)
+                if filter_blobs:
+                    cmd += ' --filter=blob:none'
+                if shallow_since is not None:
+                    cmd += ' --shallow-since=%s' % shallow_since
+            elif (skip_unchanged and fingerprint is not None and
+                  fingerprints.get(repo_path) == fingerprint):
+                if not quiet:
+                    print('skip unchanged %s' % repo_path[1:])
+                continue
             else:
                 cmd = 'git --git-dir=%s remote update' % local_path
             if not quiet:
                 print(cmd)
-                subprocess.call(cmd.split())
-            else:
-                with open(os.devnull, 'w') as f:
-                    subprocess.call(cmd.split(), stdout=f)
-    hkml_list.writeback_list_output_cache()
+            repos.append([cmd, local_path, repo_path[1:], mlist, fingerprint])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(
+            lambda repo: fetch_repo(repo[0], repo[1], repo[2], quiet),
+            repos))
+
+    for [cmd, local_path, name, mlist, fingerprint], [rc, _, _] in zip(
+            repos, results):
+        if hkml_index.is_indexed(local_path):
+            hkml_index.index_epoch(local_path, quiet)
+        if rc == 0:
+            hkml_maintain.update_date_index(local_path)
+        if rc == 0 and fingerprint is not None:
+            fingerprints['/%s' % name] = fingerprint
+    write_fingerprints(fingerprints)
+    hkml_maintain.writeback_date_index()
+
+    if quiet:
+        return
+    print('# fetch summary')
+    for [cmd, local_path, name, _, _], [rc, seconds, nr_bytes] in zip(
+            repos, results):
+        print('# %s: %s, %.3f seconds, %d bytes' % (
+            name, 'ok' if rc == 0 else 'failed (%d)' % rc, seconds,
+            nr_bytes))
 
 def fetched_mail_lists():
     archive_dir = os.path.join(_hkml.get_hkml_dir(), 'archives')
@@ -46,6 +165,22 @@ def set_argparser(parser):
             help='Work silently.')
     parser.add_argument('--epochs', type=int, default=1,
             help='Minimum number of last epochs to fetch')
+    parser.add_argument('--jobs', '-j', metavar='<int>', type=int, default=1,
+            help='Number of repositories to fetch concurrently')
+    parser.add_argument('--skip_unchanged', action='store_true',
+            help=' '.join([
+                'Skip repositories having same manifest fingerprint to that',
+                'of the last fetch']))
+    parser.add_argument('--update_manifest', action='store_true',
+            help=' '.join([
+                'Download the latest manifest from the site to the default',
+                'manifest file first']))
+    parser.add_argument('--filter_blobs', action='store_true',
+            help=' '.join([
+                'Do partial clone of new repositories.  Mails are downloaded',
+                'when those are really read']))
+    parser.add_argument('--shallow_since', metavar='<date>',
+            help='Do shallow clone of new repositories since the date')
 
 def main(args=None):
     if not args:
@@ -59,8 +194,13 @@ def main(args=None):
     if not mail_lists:
         print('mail lists to fetch is not specified')
         exit(1)
+    if args.update_manifest and args.manifest is not None:
+        print('--update_manifest cannot be used with --manifest')
+        exit(1)
     quiet = args.quiet
-    fetch_mail(mail_lists, quiet, args.epochs)
+    fetch_mail(mail_lists, quiet, args.epochs, args.jobs,
+               args.skip_unchanged, args.update_manifest, args.filter_blobs,
+               args.shallow_since)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0
+
+import argparse
+import email.utils
+import os
+import re
+import sqlite3
+import subprocess
+
+import _hkml
+
+'''
+Index of header fields of the mails in the fetched mailing list archives.
+
+The index is saved in 'mails_index.db' sqlite database under the hkml
+directory.  'epochs' table has the last indexed commit of each fetched epoch
+git repository, which is identified by its path under 'archives' directory.
+'headers' table has the header fields of the indexed mails, keyed by the epoch
+and the commit of the mail.  Indexing an epoch starts from its last indexed
+commit, so only newly fetched mails are read after the first indexing.
+
+'tokens' and 'postings' tables are an inverted index of the words in the
+subject and the body of the mails.  'tokens' table maps each word to an id,
+and 'postings' table has the mails having each word.  Keyword filters use it
+for narrowing down the mails to read.  Similarly, 'field_postings' table has
+the mails having each lower-cased word in their from:, to:, cc: and subject:
+fields, for 'hkml search'.  The postings identify the mails with the integer
+'id' of 'headers' table rows, and the gitids are read only for the final
+candidates.
+
+'thread_links' table has the parent and child message ids of the reply
+relationships, which are found from in-reply-to: and references: fields of the
+mails.  Since references: field has the ancestors of the mail, it links mails
+of a thread even if some mails of the thread are not fetched.
+
+'thread_summaries' table has a summary of each thread in each mailing list,
+namely the root message id, the subject, the number of mails of the series,
+the number of replies and comments, and the dates of the first and the last
+mails of the thread.  Only mails of the mailing list are counted.  The
+commit of the first mail of the thread is also saved, to show it without
+reading other mails.  Summaries of the threads having newly indexed mails are
+updated at the indexing.
+
+The version of the database format is saved as the 'user_version' of the
+database.  Databases of a different version are reset.
+'''
+
+index_db_version = 5
+
+# header fields having their own inverted index
+indexed_fields = ['from', 'to', 'cc', 'subject']
+
+# header fields to index, and the name of the columns for those
+header_columns = {
+        'message-id': 'msgid',
+        'in-reply-to': 'in_reply_to',
+        'references': 'refs',
+        'from': 'from_',
+        'to': 'to_',
+        'cc': 'cc',
+        'date': 'date',
+        'subject': 'subject',
+        }
+
+index_db = None
+
+def index_db_path():
+    return os.path.join(_hkml.get_hkml_dir(), 'mails_index.db')
+
+def get_index_db(create=False):
+    global index_db
+
+    if index_db is not None:
+        return index_db
+    if not create and not os.path.isfile(index_db_path()):
+        return None
+
+    index_db = sqlite3.connect(index_db_path())
+    if index_db.execute('PRAGMA user_version').fetchone()[0] != \
+            index_db_version:
+        with index_db:
+            for table in ['epochs', 'headers', 'tokens', 'postings',
+                          'field_postings', 'thread_links',
+                          'thread_summaries']:
+                index_db.execute('DROP TABLE IF EXISTS %s' % table)
+            index_db.execute('PRAGMA user_version = %d' % index_db_version)
+    index_db.execute(
+            '''CREATE TABLE IF NOT EXISTS epochs (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,
+                last_commit TEXT)''')
+    index_db.execute(
+            '''CREATE TABLE IF NOT EXISTS headers (
+                id INTEGER PRIMARY KEY, epoch INTEGER NOT NULL,
+                gitid TEXT NOT NULL, %s, UNIQUE (epoch, gitid))''' %
+            ', '.join(['%s TEXT' % c for c in header_columns.values()]))
+    index_db.execute(
+            '''CREATE TABLE IF NOT EXISTS tokens (
+                id INTEGER PRIMARY KEY, token TEXT UNIQUE NOT NULL)''')
+    index_db.execute(
+            '''CREATE TABLE IF NOT EXISTS postings (
+                token INTEGER NOT NULL, epoch INTEGER NOT NULL,
+                mail INTEGER NOT NULL,
+                PRIMARY KEY (token, epoch, mail)) WITHOUT ROWID''')
+    index_db.execute(
+            '''CREATE TABLE IF NOT EXISTS field_postings (
+                field TEXT NOT NULL, token INTEGER NOT NULL,
+                epoch INTEGER NOT NULL, mail INTEGER NOT NULL,
+                PRIMARY KEY (field, token, epoch, mail)) WITHOUT ROWID''')
+    index_db.execute(
+            'CREATE INDEX IF NOT EXISTS headers_msgid ON headers (msgid)')
+    index_db.execute(
+            '''CREATE TABLE IF NOT EXISTS thread_links (
+                parent TEXT NOT NULL, child TEXT NOT NULL,
+                PRIMARY KEY (parent, child)) WITHOUT ROWID''')
+    index_db.execute(
+            '''CREATE INDEX IF NOT EXISTS thread_links_child
+                ON thread_links (child)''')
+    index_db.execute(
+            '''CREATE TABLE IF NOT EXISTS thread_summaries (
+                list TEXT NOT NULL, root TEXT NOT NULL, subject TEXT,
+                series_total INTEGER, nr_replies INTEGER,
+                nr_comments INTEGER, first_date REAL, last_date REAL,
+                epoch INTEGER, gitid TEXT,
+                PRIMARY KEY (list, root)) WITHOUT ROWID''')
+    index_db.execute(
+            '''CREATE INDEX IF NOT EXISTS thread_summaries_last_date
+                ON thread_summaries (list, last_date)''')
+    return index_db
+
+def archives_dir():
+    return os.path.join(_hkml.get_hkml_dir(), 'archives')
+
+def epoch_path_of(mdir):
+    # e.g., 'linux-mm/git/0.git'
+    return os.path.relpath(mdir, archives_dir())
+
+def mail_list_of(mdir):
+    # e.g., 'linux-mm' for 'archives/linux-mm/git/0.git'
+    return os.path.relpath(os.path.dirname(os.path.dirname(mdir)),
+                           archives_dir())
+
+def get_epoch_id(db, mdir, create=False):
+    epoch_path = epoch_path_of(mdir)
+    if create:
+        db.execute('INSERT OR IGNORE INTO epochs (path) VALUES (?)',
+                   (epoch_path,))
+    row = db.execute('SELECT id FROM epochs WHERE path = ?',
+                     (epoch_path,)).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def is_indexed(mdir):
+    db = get_index_db()
+    if db is None:
+        return False
+    return get_epoch_id(db, mdir) is not None
+
+def tokenize(text):
+    if text is None:
+        return set()
+    return set(re.findall(r'\w+', text))
+
+def parse_mbox(mbox, subject):
+    mail = _hkml.Mail()
+    mail.mbox = mbox
+    fields = [mail.get_field(field) for field in header_columns]
+    # 'list' checks subject keywords against the commit subject
+    tokens = tokenize(subject) | tokenize(mail.get_field('subject')) | \
+            tokenize(mail.get_field('body'))
+    field_tokens = {}
+    for field in indexed_fields:
+        text = mail.get_field(field)
+        if field == 'subject':
+            text = '%s %s' % (subject, text)
+        if text is not None:
+            field_tokens[field] = tokenize(text.lower())
+    return fields, tokens, field_tokens
+
+def thread_links_of(msgid, in_reply_to, references):
+    if msgid is None:
+        return []
+    chain = re.findall(r'<[^>]+>', references or '')
+    parents = re.findall(r'<[^>]+>', in_reply_to or '')
+    if parents and (not chain or chain[-1] != parents[0]):
+        chain.append(parents[0])
+    chain.append(msgid)
+    return [[chain[i], chain[i + 1]] for i in range(len(chain) - 1)
+            if chain[i] != chain[i + 1]]
+
+def commits_to_index(mdir, last_commit):
+    # oldest first.  None if the history is rewritten
+    cmd = ['git', '--git-dir=%s' % mdir, 'log', '--reverse',
+           '--pretty=%H %s', 'HEAD']
+    if last_commit is not None:
+        # objects of the old history may still exist
+        if subprocess.call(['git', '--git-dir=%s' % mdir, 'merge-base',
+                            '--is-ancestor', last_commit, 'HEAD'],
+                           stderr=subprocess.DEVNULL) != 0:
+            return None
+        cmd.append('^%s' % last_commit)
+    try:
+        lines = _hkml.cmd_lines_output(cmd)
+    except subprocess.CalledProcessError:
+        return None
+    commits = []
+    for line in lines:
+        if not line:
+            continue
+        fields = line.split(' ', 1)
+        commits.append([fields[0], fields[1] if len(fields) > 1 else ''])
+    return commits
+
+def select_in_chunks(db, sql, values, params=[]):
+    # 'sql' should have '%s' for the placeholders of each chunk of 'values'
+    values = list(values)
+    chunk_size = 512
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        for row in db.execute(sql % ', '.join(['?'] * len(chunk)),
+                              list(params) + chunk):
+            yield row
+
+def get_token_ids(db, tokens):
+    tokens = list(tokens)
+    db.executemany('INSERT OR IGNORE INTO tokens (token) VALUES (?)',
+                   [(token,) for token in tokens])
+    token_ids = {}
+    for token_id, token in select_in_chunks(
+            db, 'SELECT id, token FROM tokens WHERE token IN (%s)', tokens):
+        token_ids[token] = token_id
+    return token_ids
+
+def unindex_epoch(db, mdir, epoch_id):
+    links = []
+    # mails of the threads, to update the links and summaries after the
+    # removal
+    thread_mails = {}
+    for msgid, in_reply_to, refs in db.execute(
+            '''SELECT msgid, in_reply_to, refs FROM headers
+            WHERE epoch = ?''', (epoch_id,)).fetchall():
+        links += thread_links_of(msgid, in_reply_to, refs)
+        if msgid is None or msgid in thread_mails:
+            continue
+        for thread_msgid in thread_descendants(db, thread_root(db, msgid)):
+            thread_mails[thread_msgid] = True
+    thread_mails = list(thread_mails)
+
+    db.execute('DELETE FROM headers WHERE epoch = ?', (epoch_id,))
+    db.execute('DELETE FROM postings WHERE epoch = ?', (epoch_id,))
+    db.execute('DELETE FROM field_postings WHERE epoch = ?', (epoch_id,))
+    db.executemany('DELETE FROM thread_links WHERE parent = ? AND child = ?',
+                   links)
+    # restore the links that remaining mails also imply
+    links = []
+    for row in select_in_chunks(
+            db, '''SELECT msgid, in_reply_to, refs FROM headers
+            WHERE msgid IN (%s)''', thread_mails):
+        links += thread_links_of(*row)
+    db.executemany('INSERT OR IGNORE INTO thread_links VALUES (?, ?)', links)
+    update_thread_summaries(db, mail_list_of(mdir), thread_mails)
+    db.execute('UPDATE epochs SET last_commit = NULL WHERE id = ?',
+               (epoch_id,))
+
+def index_epoch(mdir, quiet=False):
+    db = get_index_db(create=True)
+    with db:
+        epoch_id = get_epoch_id(db, mdir, create=True)
+    last_commit = db.execute('SELECT last_commit FROM epochs WHERE id = ?',
+                             (epoch_id,)).fetchone()[0]
+
+    commits = commits_to_index(mdir, last_commit)
+    if commits is None and last_commit is not None:
+        # the history has rewritten.  Index from the scratch.
+        with db:
+            unindex_epoch(db, mdir, epoch_id)
+        commits = commits_to_index(mdir, None)
+    if commits is None:
+        print('reading commits of %s failed' % mdir)
+        return
+
+    chunk_size = 1024
+    for i in range(0, len(commits), chunk_size):
+        chunk = commits[i:i + chunk_size]
+        gitids = [gitid for gitid, _ in chunk]
+        rows = []
+        mails_tokens = []
+        links = []
+        for [gitid, subject], mbox in zip(
+                chunk, _hkml.read_git_mboxes(mdir, gitids)):
+            if mbox is None:
+                continue
+            fields, tokens, field_tokens = parse_mbox(mbox, subject)
+            rows.append([epoch_id, gitid] + fields)
+            mails_tokens.append([gitid, tokens, field_tokens])
+            links += thread_links_of(*fields[:3])
+        with db:
+            db.executemany(
+                    'INSERT OR IGNORE INTO headers (epoch, gitid, %s) '
+                    'VALUES (%s)' % (
+                        ', '.join(header_columns.values()),
+                        ', '.join(['?'] * (len(header_columns) + 2))), rows)
+            mail_ids = indexed_mail_ids(
+                    db, epoch_id, [gitid for gitid, _, _ in mails_tokens])
+            all_tokens = set()
+            for _, tokens, field_tokens in mails_tokens:
+                all_tokens |= tokens
+                for ftokens in field_tokens.values():
+                    all_tokens |= ftokens
+            token_ids = get_token_ids(db, all_tokens)
+            db.executemany(
+                    'INSERT OR IGNORE INTO postings VALUES (?, ?, ?)',
+                    [(token_ids[token], epoch_id, mail_ids[gitid])
+                     for gitid, tokens, _ in mails_tokens
+                     for token in tokens])
+            db.executemany(
+                    'INSERT OR IGNORE INTO field_postings VALUES (?, ?, ?, ?)',
+                    [(field, token_ids[token], epoch_id, mail_ids[gitid])
+                     for gitid, _, field_tokens in mails_tokens
+                     for field, tokens in field_tokens.items()
+                     for token in tokens])
+            db.executemany('INSERT OR IGNORE INTO thread_links VALUES (?, ?)',
+                           links)
+            update_thread_summaries(db, mail_list_of(mdir),
+                                    [row[2] for row in rows])
+            db.execute('UPDATE epochs SET last_commit = ? WHERE id = ?',
+                       (gitids[-1], epoch_id))
+    if not quiet:
+        print('%s: %d mails indexed' % (epoch_path_of(mdir), len(commits)))
+
+def get_indexed_headers(mdir, gitids):
+    db = get_index_db()
+    if db is None:
+        return {}
+    epoch_id = get_epoch_id(db, mdir)
+    if epoch_id is None:
+        return {}
+
+    headers = {}
+    sql = ('SELECT gitid, %s FROM headers WHERE epoch = ? AND gitid IN (%%s)'
+           % ', '.join(header_columns.values()))
+    for row in select_in_chunks(db, sql, gitids, [epoch_id]):
+        headers[row[0]] = dict(zip(header_columns.keys(), row[1:]))
+    return headers
+
+def keyword_token_patterns(keyword):
+    # first and last tokens could be a part of longer tokens of the text
+    patterns = []
+    matches = list(re.finditer(r'\w+', keyword))
+    for idx, match in enumerate(matches):
+        pattern = match.group()
+        if idx == 0 and match.start() == 0:
+            pattern = '%' + pattern
+        if idx == len(matches) - 1 and match.end() == len(keyword):
+            pattern = pattern + '%'
+        patterns.append(pattern)
+    return patterns
+
+def token_posting_query(select, pattern, field):
+    if not '%' in pattern:
+        where = 'token = ?'
+    else:
+        # LIKE is case-insensitive, but that's fine for narrowing down
+        where = 'token LIKE ?'
+    if field is None:
+        return ('''SELECT %s FROM postings WHERE epoch = ? AND token IN
+                (SELECT id FROM tokens WHERE %s)''' % (select, where))
+    return ('''SELECT %s FROM field_postings WHERE field = ? AND epoch = ?
+            AND token IN (SELECT id FROM tokens WHERE %s)''' %
+            (select, where))
+
+def mail_ids_having_tokens(db, epoch_id, pattern, field=None):
+    params = (epoch_id, pattern)
+    if field is not None:
+        params = (field,) + params
+    return set([row[0] for row in db.execute(
+        token_posting_query('mail', pattern, field), params)])
+
+def nr_mails_having_tokens(db, epoch_id, pattern, field=None):
+    params = (epoch_id, pattern)
+    if field is not None:
+        params = (field,) + params
+    return db.execute(token_posting_query('COUNT(*)', pattern, field),
+                      params).fetchone()[0]
+
+def indexed_mail_ids(db, epoch_id, gitids):
+    return dict(select_in_chunks(
+        db, 'SELECT gitid, id FROM headers WHERE epoch = ? AND gitid IN (%s)',
+        gitids, [epoch_id]))
+
+def gitids_of_mail_ids(db, mail_ids):
+    return set([row[0] for row in select_in_chunks(
+        db, 'SELECT gitid FROM headers WHERE id IN (%s)', mail_ids)])
+
+def mails_may_have_keywords(mails, keywords):
+    db = get_index_db()
+    if db is None or not keywords:
+        return mails
+    patterns = []
+    for keyword in keywords:
+        patterns += keyword_token_patterns(keyword)
+    if not patterns:
+        return mails
+    # exact match first, since it is cheaper
+    patterns.sort(key=lambda p: '%' in p)
+
+    mdir_mails = {}
+    for mail in mails:
+        if mail.gitdir is None or mail.gitid is None:
+            continue
+        if not mail.gitdir in mdir_mails:
+            mdir_mails[mail.gitdir] = []
+        mdir_mails[mail.gitdir].append(mail)
+
+    excluded = {}
+    for mdir, epoch_mails in mdir_mails.items():
+        epoch_id = get_epoch_id(db, mdir)
+        if epoch_id is None:
+            continue
+        candidates = None
+        for pattern in patterns:
+            mail_ids = mail_ids_having_tokens(db, epoch_id, pattern)
+            if candidates is None:
+                candidates = mail_ids
+            else:
+                candidates &= mail_ids
+            if not candidates:
+                break
+        indexed = indexed_mail_ids(db, epoch_id,
+                                   [m.gitid for m in epoch_mails])
+        for mail in epoch_mails:
+            if mail.gitid in indexed and not indexed[mail.gitid] in candidates:
+                excluded[id(mail)] = True
+    return [m for m in mails if not id(m) in excluded]
+
+def thread_root(db, msgid):
+    root = msgid
+    ancestors = {root: True}
+    while True:
+        row = db.execute('SELECT parent FROM thread_links WHERE child = ?',
+                         (root,)).fetchone()
+        if row is None or row[0] in ancestors:
+            break
+        root = row[0]
+        ancestors[root] = True
+    return root
+
+def thread_descendants(db, root):
+    # breadth first order
+    msgids = [root]
+    seen = {root: True}
+    idx = 0
+    while idx < len(msgids):
+        for row in db.execute(
+                'SELECT child FROM thread_links WHERE parent = ?',
+                (msgids[idx],)):
+            if not row[0] in seen:
+                seen[row[0]] = True
+                msgids.append(row[0])
+        idx += 1
+    return msgids
+
+def date_to_epoch(date):
+    try:
+        return email.utils.mktime_tz(email.utils.parsedate_tz(date))
+    except:
+        return None
+
+def update_thread_summaries(db, mail_list, msgids):
+    roots = {}
+    for msgid in msgids:
+        if msgid is not None:
+            roots[thread_root(db, msgid)] = True
+    prefix = '%s/' % mail_list
+    for root in roots:
+        thread = thread_descendants(db, root)
+        mails = {}
+        for msgid, in_reply_to, subject, date, epoch, gitid in \
+                select_in_chunks(
+                        db, '''SELECT headers.msgid, headers.in_reply_to,
+                        headers.subject, headers.date, headers.epoch,
+                        headers.gitid FROM headers JOIN epochs
+                        ON headers.epoch = epochs.id
+                        WHERE substr(epochs.path, 1, ?) = ?
+                        AND headers.msgid IN (%s)''',
+                        thread, [len(prefix), prefix]):
+            mails[msgid] = [in_reply_to, subject, date_to_epoch(date),
+                            epoch, gitid]
+        # roots of the threads that merged into this thread
+        list(select_in_chunks(
+            db, '''DELETE FROM thread_summaries WHERE list = ? AND
+            root IN (%s)''', thread, [mail_list]))
+        dates = [m[2] for m in mails.values() if m[2] is not None]
+        if not dates:
+            continue
+        first = min([m for m in mails.values() if m[2] is not None],
+                    key=lambda m: m[2])
+        in_reply_to, subject, first_date, epoch, gitid = first
+
+        mail = _hkml.Mail()
+        mail.subject = subject or ''
+        mail.set_subject_tags_series()
+        series_total = mail.series[1] if mail.series is not None else None
+        nr_replies = len(mails) - 1
+        nr_comments = nr_replies
+        # Exclude replies that sent together as a patch series
+        if not in_reply_to and series_total is not None:
+            nr_comments -= series_total
+        db.execute(
+                '''INSERT INTO thread_summaries VALUES
+                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (mail_list, root, subject, series_total, nr_replies,
+                 nr_comments, first_date, max(dates), epoch, gitid))
+
+def get_thread_summaries(mail_list, since, until):
+    # None if the list is not indexed
+    db = get_index_db()
+    if db is None:
+        return None
+    prefix = '%s/' % mail_list
+    if db.execute('SELECT 1 FROM epochs WHERE substr(path, 1, ?) = ?',
+                  (len(prefix), prefix)).fetchone() is None:
+        return None
+    summaries = []
+    for row in db.execute(
+            '''SELECT epochs.path, thread_summaries.* FROM thread_summaries
+            JOIN epochs ON thread_summaries.epoch = epochs.id
+            WHERE list = ? AND last_date >= ? AND first_date < ?''',
+            (mail_list, since, until)):
+        summary = dict(zip(
+            ['path', 'list', 'root', 'subject', 'series_total', 'nr_replies',
+             'nr_comments', 'first_date', 'last_date', 'epoch', 'gitid'],
+            row))
+        summary['mdir'] = os.path.join(archives_dir(), summary['path'])
+        summaries.append(summary)
+    return summaries
+
+def thread_msgids(msgid):
+    # None if the thread links of the mail are not indexed
+    db = get_index_db()
+    if db is None:
+        return None
+    msgids = thread_descendants(db, thread_root(db, msgid))
+    if len(msgids) == 1 and db.execute(
+            'SELECT 1 FROM headers WHERE msgid = ?', (msgid,)).fetchone() \
+                    is None:
+        return None
+    return msgids
+
+def locate_mails(msgids):
+    db = get_index_db()
+    if db is None:
+        return {}
+    mdir_gitids = {}
+    located = {}
+    for msgid, path, gitid in select_in_chunks(
+            db, '''SELECT headers.msgid, epochs.path, headers.gitid
+            FROM headers JOIN epochs ON headers.epoch = epochs.id
+            WHERE headers.msgid IN (%s)''', msgids):
+        # same mail could be sent to multiple lists
+        if msgid in located:
+            continue
+        located[msgid] = True
+        mdir = os.path.join(archives_dir(), path)
+        if not mdir in mdir_gitids:
+            mdir_gitids[mdir] = []
+        mdir_gitids[mdir].append(gitid)
+    return mdir_gitids
+
+def epoch_dirs(mail_lists):
+    mdirs = []
+    for mail_list in mail_lists:
+        git_dir = os.path.join(archives_dir(), mail_list, 'git')
+        if not os.path.isdir(git_dir):
+            print('%s is not fetched' % mail_list)
+            continue
+        for epoch in sorted(os.listdir(git_dir)):
+            if epoch.endswith('.git'):
+                mdirs.append(os.path.join(git_dir, epoch))
+    return mdirs
+
+def set_argparser(parser):
+    parser.description = 'index fetched mails'
+    parser.add_argument('mlist', metavar='<mailing list>', nargs='*',
+            help='mailing list to index.  Index all fetched lists by default')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+            help='Work silently.')
+
+def main(args=None):
+    if not args:
+        parser = argparse.ArgumentParser()
+        set_argparser(parser)
+        args = parser.parse_args()
+
+    mail_lists = args.mlist
+    if not mail_lists:
+        mail_lists = [d for d in os.listdir(archives_dir())
+                      if os.path.isdir(os.path.join(archives_dir(), d))]
+    for mdir in epoch_dirs(mail_lists):
+        index_epoch(mdir, args.quiet)
+
+if __name__ == '__main__':
+    main()
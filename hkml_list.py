@@ -2,143 +2,247 @@
 # SPDX-License-Identifier: GPL-2.0
 
 import argparse
+import concurrent.futures
 import copy
 import datetime
+import heapq
 import json
 import math
 import os
+import sqlite3
+import subprocess
+import sys
 import time
 
 import _hkml
 import hkml_cache
 import hkml_fetch
+import hkml_index
+import hkml_maintain
 import hkml_open
 import hkml_tag
 
 '''
 Contains list command generated outputs to cache for later fast processing.
-Keys are the json string of the list command arguments, or 'thread_output'.
-Values are a dict containing below key/values.
-- 'output': the list command's terminal output string.
-- 'index_to_cache_key': a dict having the mail index on the output as keys, and
-  the corresponding mail's key in the mail cache as values.
-- 'date': last accessed date
+The outputs are saved in a SQLite database file, 'list_outputs.db', under the
+hkml directory, so that commands like 'hkml open' read and write only the
+records that they really need.
+
+'list_outputs' table has one record per list command invocation.  The key of
+the record is the json string of the list command arguments, or
+'thread_output'.  Each record has the list command's terminal output string,
+the last accessed time, and the mail index that last referenced via 'hkml
+open' like commands, if any.  'list_output_indexes' table has the mail index
+on each output and the corresponding mail's key in the mail cache.  The most
+recently accessed output is the last output.
+
+'list_output_epochs' table has the epochs of the mailing lists that each
+output is made from, their heads at the time, and the git log output lines of
+the epochs for the output, latest first.  If the head of any of the epochs is
+changed, e.g., by a fetch, or a newer epoch is fetched, the output is
+outdated.  The output is then made again, but reading only the commits that
+newer than the old heads from git.
+
+Outputs of old versions, which were saved in a single json file called
+'list_output_cache', are imported at the first use of the database.
 '''
-list_output_cache = None
+list_outputs_db = None
+
+max_nr_list_outputs = 64
 
 def list_output_cache_file_path():
+    # the json file of old versions
     return os.path.join(_hkml.get_hkml_dir(), 'list_output_cache')
 
+def list_outputs_db_path():
+    return os.path.join(_hkml.get_hkml_dir(), 'list_outputs.db')
+
 def args_to_list_output_key(args):
     dict_ = copy.deepcopy(args.__dict__)
     dict_['fetch'] = False
     dict_['stdout'] = False
+    dict_['background_fetch'] = False
+    dict_['background_worker'] = None
+    dict_['profile_startup'] = False
 
     return json.dumps(dict_, sort_keys=True)
 
-def get_list_output_cache():
-    global list_output_cache
-
-    if list_output_cache is None:
-        if not os.path.isfile(list_output_cache_file_path()):
-            list_output_cache = {}
-        else:
-            with open(list_output_cache_file_path(), 'r') as f:
-                list_output_cache = json.load(f)
-    if list_output_cache is None:
-        list_output_cache = {}
-    return list_output_cache
-
-def writeback_list_output():
-    cache = get_list_output_cache()
-    with open(list_output_cache_file_path(), 'w') as f:
-        json.dump(cache, f, indent=4)
-
-def get_cached_list_outputs(key):
-    cache = get_list_output_cache()
-    if not key in cache:
+def import_list_output_cache(db):
+    if not os.path.isfile(list_output_cache_file_path()):
+        return
+    try:
+        with open(list_output_cache_file_path(), 'r') as f:
+            cache = json.load(f)
+    except:
+        cache = {}
+    for key, outputs in cache.items():
+        try:
+            date = datetime.datetime.strptime(
+                    outputs['date'], '%Y-%m-%d-%H-%M-%S').timestamp()
+        except:
+            continue
+        last_reference = None
+        output = outputs['output']
+        if output.startswith('# last reference: '):
+            lines = output.split('\n')
+            last_reference = int(lines[0].split()[-1])
+            output = '\n'.join(lines[2:])
+        db.execute('INSERT OR REPLACE INTO list_outputs VALUES (?, ?, ?, ?)',
+                   (key, output, date, last_reference))
+        db.executemany(
+                'INSERT OR REPLACE INTO list_output_indexes VALUES (?, ?, ?)',
+                [(key, int(idx), cache_key) for idx, cache_key in
+                 outputs['index_to_cache_key'].items()])
+    os.remove(list_output_cache_file_path())
+
+def get_list_outputs_db():
+    global list_outputs_db
+
+    if list_outputs_db is not None:
+        return list_outputs_db
+
+    list_outputs_db = sqlite3.connect(list_outputs_db_path())
+    with list_outputs_db:
+        list_outputs_db.execute(
+                '''CREATE TABLE IF NOT EXISTS list_outputs (
+                    key TEXT PRIMARY KEY, output TEXT NOT NULL,
+                    date REAL NOT NULL, last_reference INTEGER)''')
+        list_outputs_db.execute(
+                '''CREATE INDEX IF NOT EXISTS list_outputs_date
+                    ON list_outputs (date)''')
+        list_outputs_db.execute(
+                '''CREATE TABLE IF NOT EXISTS list_output_indexes (
+                    key TEXT NOT NULL, idx INTEGER NOT NULL,
+                    cache_key TEXT NOT NULL,
+                    PRIMARY KEY (key, idx)) WITHOUT ROWID''')
+        list_outputs_db.execute(
+                '''CREATE TABLE IF NOT EXISTS list_output_epochs (
+                    key TEXT NOT NULL, mdir TEXT NOT NULL,
+                    head TEXT NOT NULL, lines TEXT,
+                    PRIMARY KEY (key, mdir)) WITHOUT ROWID''')
+        import_list_output_cache(list_outputs_db)
+    return list_outputs_db
+
+def last_list_output_key(not_thread_output=False):
+    query = 'SELECT key FROM list_outputs'
+    if not_thread_output:
+        query += ' WHERE key != \'thread_output\''
+    row = get_list_outputs_db().execute(
+            query + ' ORDER BY date DESC LIMIT 1').fetchone()
+    if row is None:
         return None
-    outputs = cache[key]
-    outputs['date'] = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-    return outputs
+    return row[0]
 
 def get_list_str(key):
-    outputs = get_cached_list_outputs(key)
-    if outputs is None:
+    # also mark the output as the last one
+    db = get_list_outputs_db()
+    row = db.execute(
+            'SELECT output, last_reference FROM list_outputs WHERE key = ?',
+            (key,)).fetchone()
+    if row is None:
         return None
-    return outputs['output']
+    with db:
+        db.execute('UPDATE list_outputs SET date = ? WHERE key = ?',
+                   (time.time(), key))
+    output, last_reference = row
+    if last_reference is not None:
+        output = '\n'.join(['# last reference: %d' % last_reference, '#',
+                            output])
+    return output
 
 def get_last_list_str():
-    cache = get_list_output_cache()
-    keys = [k for k in cache if k != 'thread_output']
-    key = sorted(keys, key=lambda x: cache[x]['date'])[-1]
-    outputs = get_cached_list_outputs(key)
-    if outputs is None:
+    key = last_list_output_key(not_thread_output=True)
+    if key is None:
         return None
-    return outputs['output']
+    return get_list_str(key)
 
 def get_last_thread_str():
-    cache = get_list_output_cache()
-    outputs = get_cached_list_outputs('thread_output')
-    if outputs is None:
-        return None
-    return outputs['output']
+    return get_list_str('thread_output')
+
+def delete_list_outputs(db, keys):
+    keys = [[key] for key in keys]
+    db.executemany('DELETE FROM list_outputs WHERE key = ?', keys)
+    db.executemany('DELETE FROM list_output_indexes WHERE key = ?', keys)
+    db.executemany('DELETE FROM list_output_epochs WHERE key = ?', keys)
+
+def cache_list_str(key, list_str, epochs=None):
+    # 'epochs' has the heads and the git log lines (could be None) of the
+    # epochs that the output is made from
+    db = get_list_outputs_db()
+    with db:
+        delete_list_outputs(db, [key])
+        db.execute('INSERT INTO list_outputs VALUES (?, ?, ?, ?)',
+                   (key, '\n'.join(['# (cached output)', list_str]),
+                    time.time(), None))
+        db.executemany(
+                'INSERT INTO list_output_indexes VALUES (?, ?, ?)',
+                [(key, int(idx), cache_key) for idx, cache_key in
+                 mail_idx_key_mapping.items()])
+        if epochs is not None:
+            db.executemany(
+                    'INSERT INTO list_output_epochs VALUES (?, ?, ?, ?)',
+                    [(key, mdir, head,
+                      '\n'.join(lines) if lines is not None else None)
+                     for mdir, [head, lines] in epochs.items()])
+        old_keys = db.execute(
+                'SELECT key FROM list_outputs ORDER BY date DESC LIMIT -1 '
+                'OFFSET ?', (max_nr_list_outputs,)).fetchall()
+        delete_list_outputs(db, [key for key, in old_keys])
+
+def cache_list_output(key, list_str, epochs):
+    hkml_cache.writeback_mails()
+    cache_list_str(key, list_str, epochs)
+
+def get_cached_list_output_epochs(key):
+    epochs = {}
+    for mdir, head, lines in get_list_outputs_db().execute(
+            'SELECT mdir, head, lines FROM list_output_epochs WHERE key = ?',
+            (key,)):
+        if lines is not None:
+            lines = [line for line in lines.split('\n') if line]
+        epochs[mdir] = [head, lines]
+    return epochs
+
+def next_epoch_dir(mdir):
+    # e.g., '.../1.git' for '.../0.git'
+    epoch = int(os.path.basename(mdir).split('.git')[0])
+    return os.path.join(os.path.dirname(mdir), '%d.git' % (epoch + 1))
+
+def list_output_outdated(epochs):
+    for mdir, [head, _] in epochs.items():
+        if hkml_maintain.epoch_head(mdir) != head:
+            return True
+        if (os.path.isdir(next_epoch_dir(mdir)) and
+                not next_epoch_dir(mdir) in epochs):
+            return True
+    return False
 
-def invalidate_cached_outputs(source):
-    keys_to_del = []
-    cache = get_list_output_cache()
-    for key in cache.keys():
-        try:
-            key_dict = json.loads(key)
-            if key_dict['source'] == source:
-                keys_to_del.append(key)
-        except:
-            pass
-    for key in keys_to_del:
-        del cache[key]
-
-def writeback_list_output_cache():
-    cache = get_list_output_cache()
-    with open(list_output_cache_file_path(), 'w') as f:
-        json.dump(cache, f, indent=4)
-
-def cache_list_str(key, list_str):
-    cache = get_list_output_cache()
-    cache[key] = {
-            'output': '\n'.join(['# (cached output)', list_str]),
-            'index_to_cache_key': mail_idx_key_mapping,
-            'date': datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}
-    max_cache_sz = 64
-    if len(cache) == max_cache_sz:
-        keys = sorted(cache.keys(), key=lambda x: cache[x]['date'])
-        del cache[keys[0]]
-    writeback_list_output_cache()
+def mail_lists_epochs_heads(mail_lists):
+    epochs = {}
+    for mail_list in mail_lists:
+        for mdir in fetched_epoch_dirs(mail_list):
+            head = hkml_maintain.epoch_head(mdir)
+            if head is not None:
+                epochs[mdir] = [head, None]
+    return epochs
 
 # mappings from mail index to the key of the mail in the mail cache
 mail_idx_key_mapping = {}
 
 def get_mail(idx, not_thread_idx=False):
-    cache = get_list_output_cache()
-    sorted_keys = sorted(cache.keys(), key=lambda x: cache[x]['date'])
-    if not_thread_idx and sorted_keys[-1] == 'thread_output':
-        last_key = sorted_keys[-2]
-    else:
-        last_key = sorted_keys[-1]
-    idx_to_keys = cache[last_key]['index_to_cache_key']
-    idx_str = '%d' % idx
-    if not idx_str in idx_to_keys:
+    key = last_list_output_key(not_thread_idx)
+    if key is None:
         return None
-
-    output_string_lines = cache[last_key]['output'].split('\n')
-    if output_string_lines[0].startswith('# last reference: '):
-        output_string_lines = output_string_lines[2:]
-    output_string_lines = ['# last reference: %d' % idx,
-                           '#'] + output_string_lines
-    cache[last_key]['output'] = '\n'.join(output_string_lines)
-    writeback_list_output()
-
-    mail_key = idx_to_keys[idx_str]
-    return hkml_cache.get_mail(key=mail_key)
+    db = get_list_outputs_db()
+    row = db.execute(
+            '''SELECT cache_key FROM list_output_indexes
+                WHERE key = ? AND idx = ?''', (key, idx)).fetchone()
+    if row is None:
+        return None
+    with db:
+        db.execute('UPDATE list_outputs SET last_reference = ? WHERE key = ?',
+                   (idx, key))
+    return hkml_cache.get_mail(key=row[0])
 
 def map_idx_to_mail_cache_key(mail):
     idx = mail.pridx
@@ -196,15 +300,18 @@ def wrap_line(prefix, line, nr_cols):
     lines = []
     words = [prefix] + line.split(' ')
     words_to_print = []
+    # length of ' '.join(words_to_print)
+    line_len = -1
     for w in words:
         words_to_print.append(w)
-        line_len = len(' '.join(words_to_print))
+        line_len += len(w) + 1
         if line_len > nr_cols:
             if len(words_to_print) == 1:
                 lines.append(words_to_print[0])
             else:
                 lines.append(' '.join(words_to_print[:-1]))
                 words_to_print = [' ' * (len(prefix) + 1) + words_to_print[-1]]
+                line_len = len(words_to_print[0])
     lines.append(' '.join(words_to_print))
     return lines
 
@@ -224,12 +331,40 @@ def threads_of(mails):
             mail.parent_mail = orig_mail
     return threads
 
+def thread_mails(root):
+    # in the reply order
+    mails = []
+    root.prdepth = 0
+    stack = [root]
+    while stack:
+        mail = stack.pop()
+        mails.append(mail)
+        for reply in reversed(mail.replies):
+            reply.prdepth = mail.prdepth + 1
+            stack.append(reply)
+    return mails
+
+def set_thread_stats(threads):
+    # one post-order pass for each thread
+    for root in threads:
+        # replies come after their parent in the reply order
+        for mail in reversed(thread_mails(root)):
+            mail.nr_replies = 0
+            mail.last_date = None
+            if not mail.replies:
+                mail.last_date = mail.date
+            for reply in mail.replies:
+                mail.nr_replies += 1 + reply.nr_replies
+                if mail.last_date is None or mail.last_date < reply.last_date:
+                    mail.last_date = reply.last_date
+
 def orig_subject_formatted(mail):
-    if mail.parent_mail is None:
-        return False
-    if mail.parent_mail.filtered_out == False:
-        return True
-    return orig_subject_formatted(mail.parent_mail)
+    mail = mail.parent_mail
+    while mail is not None:
+        if mail.filtered_out == False:
+            return True
+        mail = mail.parent_mail
+    return False
 
 def format_entry(mail, max_digits_for_idx, show_nr_replies, show_lore_link,
                  nr_cols):
@@ -253,7 +388,7 @@ def format_entry(mail, max_digits_for_idx, show_nr_replies, show_lore_link,
         from_fields = from_fields[0:-1]
     suffices = [' '.join(from_fields), mail.date.strftime('%y/%m/%d %H:%M')]
     if show_nr_replies:
-        suffices.append('%d+ msgs' % nr_replies_of(mail))
+        suffices.append('%d+ msgs' % mail.nr_replies)
     if show_lore_link:
         suffices.append(lore_url(mail))
     suffix = ' (%s)' % ', '.join(suffices)
@@ -261,40 +396,21 @@ def format_entry(mail, max_digits_for_idx, show_nr_replies, show_lore_link,
     lines = wrap_line(prefix, subject + suffix, nr_cols)
     return lines
 
-def nr_replies_of(mail):
-    nr = len(mail.replies)
-    for re in mail.replies:
-        nr += nr_replies_of(re)
-    return nr
-
 def root_of_thread(mail):
-    if mail.parent_mail is None:
-        return mail
-    return root_of_thread(mail.parent_mail)
+    while mail.parent_mail is not None:
+        mail = mail.parent_mail
+    return mail
 
-def set_index(mail, list_, depth=0):
+def set_index(mail, list_):
     """ Make mails to be all ready for print in list"""
-    mail.pridx = len(list_)
-    mail.prdepth = depth
-    list_.append(mail)
+    for mail in thread_mails(mail):
+        mail.pridx = len(list_)
+        list_.append(mail)
 
-    map_idx_to_mail_cache_key(mail)
-
-    for mail in mail.replies:
-        set_index(mail, list_, depth + 1)
-
-def last_reply_date(mail, prev_last_date):
-    if len(mail.replies) == 0:
-        if prev_last_date == None or prev_last_date < mail.date:
-            return mail.date
-        return prev_last_date
-
-    for reply in mail.replies:
-        prev_last_date = last_reply_date(reply, prev_last_date)
-    return prev_last_date
+        map_idx_to_mail_cache_key(mail)
 
 def nr_comments(mail):
-    nr_comments = nr_replies_of(mail)
+    nr_comments = mail.nr_replies
     # Exclude replies that sent together as a patch series
     if not mail.get_field('in-reply-to') and mail.series is not None:
         nr_comments -= mail.series[1]
@@ -304,9 +420,9 @@ def sort_threads(threads, category):
     if category == 'first_date':
         return
     if category == 'last_date':
-        threads.sort(key=lambda t: last_reply_date(t, None))
+        threads.sort(key=lambda t: t.last_date)
     elif category == 'nr_replies':
-        threads.sort(key=lambda t: nr_replies_of(t))
+        threads.sort(key=lambda t: t.nr_replies)
     elif category == 'nr_comments':
         threads.sort(key=lambda t: nr_comments(t))
 
@@ -318,6 +434,18 @@ def keywords_in(keywords, text):
             return False
     return True
 
+def compile_keywords(keywords, implied_keywords=[]):
+    # keywords found together with longer or implied ones are unnecessary.
+    # Longer ones are less likely in the text, so check those first.
+    if keywords is None:
+        return []
+    keywords = set([k for k in keywords if k is not None])
+    implied_keywords = [k for k in implied_keywords if k is not None]
+    return sorted([k for k in keywords
+                   if not [o for o in keywords if o != k and k in o] and
+                   not [o for o in implied_keywords if k in o]],
+                  key=len, reverse=True)
+
 class MailListFilter:
     new_threads_only = None
     from_keywords = None
@@ -325,6 +453,10 @@ class MailListFilter:
     from_to_cc_keywords = None
     subject_keywords = None
     body_keywords = None
+    # lists of functions that return if the mail passes each condition, for
+    # header fields and for body
+    header_conditions = None
+    body_conditions = None
 
     def __init__(self, args):
         if args is None:
@@ -336,29 +468,78 @@ class MailListFilter:
         self.subject_keywords = args.subject_keywords
         self.body_keywords = args.body_keywords
 
-    def should_filter_out(self, mail):
-        if self.new_threads_only and mail.get_field('in-reply-to'):
-            return True
-        if not keywords_in(self.from_keywords, mail.get_field('from')):
-            return True
-        if not keywords_in(
-                self.from_to_keywords,
-                '%s %s' % (mail.get_field('from'), mail.get_field('to'))):
-            return True
-        if not keywords_in(
-                self.from_to_cc_keywords,
-                '%s %s %s' % (mail.get_field('from'), mail.get_field('to'),
-                              mail.get_field('cc'))):
-            return True
-        if not keywords_in(self.subject_keywords, mail.subject):
-            return True
-        if not keywords_in(self.body_keywords, mail.get_field('body')):
+    def compile_conditions(self):
+        # cheap ones first.  Reading the body could need reading the mail
+        if self.header_conditions is not None:
+            return
+        conditions = []
+        subject_keywords = compile_keywords(self.subject_keywords)
+        if subject_keywords:
+            conditions.append(
+                    lambda mail: keywords_in(subject_keywords, mail.subject))
+
+        from_keywords = compile_keywords(self.from_keywords)
+        # keywords in from: are also in 'from: to:' and 'from: to: cc:'
+        from_to_keywords = compile_keywords(
+                self.from_to_keywords, from_keywords)
+        from_to_cc_keywords = compile_keywords(
+                self.from_to_cc_keywords, from_keywords + from_to_keywords)
+        if from_keywords:
+            conditions.append(
+                    lambda mail: keywords_in(
+                        from_keywords, mail.get_field('from')))
+        if self.new_threads_only:
+            conditions.append(lambda mail: not mail.get_field('in-reply-to'))
+        if from_to_keywords or from_to_cc_keywords:
+            conditions.append(
+                    lambda mail: self.from_to_cc_match(
+                        mail, from_to_keywords, from_to_cc_keywords))
+
+        self.header_conditions = conditions
+
+        self.body_conditions = []
+        body_keywords = compile_keywords(self.body_keywords)
+        if body_keywords:
+            self.body_conditions.append(
+                    lambda mail: keywords_in(
+                        body_keywords, mail.get_field('body')))
+
+    def from_to_cc_match(self, mail, from_to_keywords, from_to_cc_keywords):
+        # get each field only once
+        from_to = '%s %s' % (mail.get_field('from'), mail.get_field('to'))
+        if not keywords_in(from_to_keywords, from_to):
+            return False
+        if not from_to_cc_keywords:
             return True
+        return keywords_in(from_to_cc_keywords,
+                           '%s %s' % (from_to, mail.get_field('cc')))
+
+    def headers_pass(self, mail):
+        self.compile_conditions()
+        for condition in self.header_conditions:
+            if not condition(mail):
+                return False
+        return True
 
+    def should_filter_out(self, mail):
+        if not self.headers_pass(mail):
+            return True
+        for condition in self.body_conditions:
+            if not condition(mail):
+                return True
         return False
 
+    def filter_candidates(self, mails):
+        keywords = []
+        for keywords_ in [self.subject_keywords, self.body_keywords]:
+            if keywords_ is not None:
+                keywords += [k for k in keywords_ if k is not None]
+        return hkml_index.mails_may_have_keywords(mails, keywords)
+
     def to_kvpairs(self):
-        kvpairs = copy.deepcopy(vars(self))
+        kvpairs = copy.deepcopy(
+                {k: v for k, v in vars(self).items()
+                 if not k in ['header_conditions', 'body_conditions']})
         return {k: v for k, v in kvpairs.items() if v is not None}
 
     @classmethod
@@ -425,8 +606,15 @@ def format_stat(mails_to_show):
 
 def mails_to_str(mails_to_show, mails_filter, list_decorator, show_thread_of,
                  runtime_profile):
+    return '\n'.join(mails_to_lines(mails_to_show, mails_filter,
+                                    list_decorator, show_thread_of,
+                                    runtime_profile))
+
+def mails_to_lines(mails_to_show, mails_filter, list_decorator,
+                   show_thread_of, runtime_profile):
     if len(mails_to_show) == 0:
-        return 'no mail'
+        yield 'no mail'
+        return
 
     if list_decorator is not None:
         show_stat = not list_decorator.hide_stat
@@ -440,10 +628,9 @@ def mails_to_str(mails_to_show, mails_filter, list_decorator, show_thread_of,
     if nr_cols is None:
         nr_cols = 80
 
-    lines = []
-
     timestamp = time.time()
     threads = threads_of(mails_to_show)
+    set_thread_stats(threads)
     for sort_category in sort_threads_by:
         sort_threads(threads, sort_category)
     if descend:
@@ -467,7 +654,7 @@ def mails_to_str(mails_to_show, mails_filter, list_decorator, show_thread_of,
         mail = by_pr_idx[show_thread_of]
         root = root_of_thread(mail)
         start_idx = root.pridx
-        end_idx = root.pridx + nr_replies_of(root) + 1
+        end_idx = root.pridx + root.nr_replies + 1
     ls_range = range(start_idx, end_idx)
 
     max_index = ls_range[-1]
@@ -475,26 +662,31 @@ def mails_to_str(mails_to_show, mails_filter, list_decorator, show_thread_of,
         max_index = 1
     max_digits_for_idx = math.ceil(math.log(max_index, 10))
 
+    candidates = None
+    if mails_filter is not None:
+        candidates = mails_filter.filter_candidates(
+                [m for m in by_pr_idx if m.pridx in ls_range])
+        if mails_filter.body_keywords:
+            # read mboxes of the mails to check the body at once, only for
+            # mails that the body is really checked for
+            _hkml.fill_mboxes([m for m in candidates
+                               if mails_filter.headers_pass(m)])
+        candidates = {id(m): True for m in candidates}
+
     filtered_mails = []
     for mail in by_pr_idx:
         if ls_range is not None and not mail.pridx in ls_range:
             mail.filtered_out = True
             continue
+        if candidates is not None and not id(mail) in candidates:
+            mail.filtered_out = True
+            continue
         if mails_filter is not None and mails_filter.should_filter_out(mail):
             mail.filtered_out = True
             continue
         mail.filtered_out = False
         filtered_mails.append(mail)
 
-    for mail in filtered_mails:
-        show_nr_replies = False
-        if collapse_threads == True:
-            if mail.prdepth > 0:
-                continue
-            show_nr_replies = True
-        lines += format_entry(mail, max_digits_for_idx, show_nr_replies,
-                              show_lore_link, nr_cols)
-
     stat_lines = []
     if show_stat:
         total_stat_lines = format_stat(mails_to_show)
@@ -509,72 +701,335 @@ def mails_to_str(mails_to_show, mails_filter, list_decorator, show_thread_of,
             stat_lines += format_stat(filtered_mails)
 
     runtime_profile_lines = []
-    total_profiled_time = sum([profile[1] for profile in runtime_profile])
+    # indented ones are details of their previous item
+    total_profiled_time = sum([profile[1] for profile in runtime_profile
+                               if not profile[0].startswith(' ')])
     if show_runtime_profile is True or total_profiled_time > 3:
         runtime_profile.append(['etc', time.time() - timestamp])
         runtime_profile_lines = ['# runtime profile']
         for key, value in runtime_profile:
             runtime_profile_lines.append('# %s: %s' % (key, value))
+        runtime_profile_lines.append(
+                '# (%d mboxes read)' % _hkml.nr_read_mboxes)
         runtime_profile_lines.append('#')
-    lines = runtime_profile_lines + stat_lines + lines
+    for line in runtime_profile_lines + stat_lines:
+        yield line
+
+    for mail in filtered_mails:
+        show_nr_replies = False
+        if collapse_threads == True:
+            if mail.prdepth > 0:
+                continue
+            show_nr_replies = True
+        for line in format_entry(mail, max_digits_for_idx, show_nr_replies,
+                                 show_lore_link, nr_cols):
+            yield line
+
+def thread_summaries_to_str(sources, since, until, list_decorator):
+    timestamp = time.time()
+    try:
+        since = datetime.datetime.strptime(since, '%Y-%m-%d').timestamp()
+        until = datetime.datetime.strptime(until, '%Y-%m-%d').timestamp()
+    except ValueError:
+        print('thread summary supports only YYYY-MM-DD format dates')
+        exit(1)
+    summaries = []
+    for source in sources:
+        source_summaries = hkml_index.get_thread_summaries(
+                source, since, until)
+        if source_summaries is None:
+            print('%s is not indexed' % source)
+            exit(1)
+        summaries += source_summaries
+    summaries.sort(key=lambda s: s['first_date'])
+
+    # read only the first mail of each thread
+    mdir_gitids = {}
+    for summary in summaries:
+        if not summary['mdir'] in mdir_gitids:
+            mdir_gitids[summary['mdir']] = []
+        mdir_gitids[summary['mdir']].append(summary['gitid'])
+    first_mails = {}
+    for mdir, gitids in mdir_gitids.items():
+        for mail in git_log_mails(mdir, None, None, gitids):
+            first_mails[(mdir, mail.gitid)] = mail
+
+    threads = []
+    roots = {}
+    for summary in summaries:
+        mail = first_mails.get((summary['mdir'], summary['gitid']))
+        # same thread could be in multiple lists
+        if mail is None or summary['root'] in roots:
+            continue
+        roots[summary['root']] = True
+        mail.nr_replies = summary['nr_replies']
+        mail.last_date = datetime.datetime.fromtimestamp(
+                summary['last_date']).astimezone()
+        threads.append(mail)
+    runtime_profile = [['get_thread_summaries', time.time() - timestamp]]
+    if not threads:
+        return 'no mail'
+
+    timestamp = time.time()
+    for sort_category in list_decorator.sort_threads_by:
+        sort_threads(threads, sort_category)
+    if not list_decorator.ascend:
+        threads.reverse()
+    if list_decorator.max_len is not None:
+        threads = threads[:list_decorator.max_len]
+
+    nr_cols = list_decorator.cols
+    if nr_cols is None:
+        nr_cols = 80
+    max_digits_for_idx = math.ceil(math.log(max(len(threads) - 1, 1), 10))
+    lines = []
+    by_pr_idx = []
+    for mail in threads:
+        mail.pridx = len(by_pr_idx)
+        mail.prdepth = 0
+        mail.filtered_out = False
+        by_pr_idx.append(mail)
+        map_idx_to_mail_cache_key(mail)
+        lines += format_entry(mail, max_digits_for_idx, True,
+                              list_decorator.lore, nr_cols)
+    runtime_profile.append(['format', time.time() - timestamp])
+
+    if not list_decorator.hide_stat:
+        lines = ['# %d threads' % len(threads)] + lines
+    if list_decorator.runtime_profile:
+        lines = ['# runtime profile'] + [
+                '# %s: %s' % (key, value) for key, value in runtime_profile
+                ] + ['#'] + lines
     return '\n'.join(lines)
 
-def git_log_output_line_to_mail(line, mdir):
+# public-inbox commits have the sender of the mail as their author
+git_log_pretty_format = '%H %ad %s%x00%an <%ae>'
+
+def git_log_output_line_to_fields(line):
+    line, _, author = line.partition('\0')
+    if not author:
+        author = None
     fields = line.split()
     if len(fields) < 3:
         return None
     subject_offset = len(fields[0]) + 1 + len(fields[1]) + 1
     subject = line[subject_offset:]
-    return _hkml.Mail.from_gitlog(fields[0], mdir, fields[1], subject)
+    return fields[0], fields[1], subject, author
 
-def get_mails_from_git(mail_list, since, until,
-                       min_nr_mails, max_nr_mails, commits_range=None):
-    lines = []
+def git_log_output_lines_to_mails(lines, mdir):
+    mails = []
+    # indices of mails not in the cache, and their git log fields
+    missed = []
+    for line in lines:
+        fields = git_log_output_line_to_fields(line)
+        if fields is None:
+            continue
+        mail = hkml_cache.get_mail(fields[0], mdir)
+        if mail is None:
+            missed.append([len(mails), fields])
+        mails.append(mail)
+
+    # use indexed header fields of the not cached mails if available
+    headers = hkml_index.get_indexed_headers(
+            mdir, [fields[0] for _, fields in missed])
+    not_indexed = []
+    for idx, fields in missed:
+        gitid, date, subject, author = fields
+        if not gitid in headers:
+            not_indexed.append([idx, fields])
+            continue
+        mails[idx] = _hkml.Mail.from_gitlog(gitid, mdir, date, subject,
+                                            header=headers[gitid],
+                                            author=author, check_cache=False)
+
+    # read mboxes of the remaining mails at once
+    mboxes = _hkml.read_git_mboxes(
+            mdir, [fields[0] for _, fields in not_indexed])
+    for [idx, fields], mbox in zip(not_indexed, mboxes):
+        gitid, date, subject, author = fields
+        mails[idx] = _hkml.Mail.from_gitlog(gitid, mdir, date, subject, mbox,
+                                            author=author, check_cache=False)
+    return mails
+
+# cache of the times of the dates that git parsed, keyed by option and date
+git_dates_time = {}
+
+def git_date_to_time(mdir, option, date):
+    key = '%s=%s' % (option, date)
+    if not key in git_dates_time:
+        # let git parse the date, e.g., '--max-age=1704067200'
+        try:
+            git_dates_time[key] = int(_hkml.cmd_str_output(
+                ['git', '--git-dir=%s' % mdir, 'rev-parse',
+                 key]).split('=')[1])
+        except:
+            git_dates_time[key] = None
+    return git_dates_time[key]
+
+def epoch_log_start(mdir, since, until, min_nr_mails):
+    # False if the epoch has no mail to list, None if the head should be used
+    segments = hkml_maintain.epoch_date_segments(mdir)
+    if not segments:
+        return None
+    since_time = None
+    if since is not None:
+        since_time = git_date_to_time(mdir, '--since', since)
+    until_time = None
+    if until is not None:
+        until_time = git_date_to_time(mdir, '--until', until)
+
+    # older mails are also listed for min_nr_mails
+    if (since_time is not None and not min_nr_mails and
+            max([s[2] for s in segments]) < since_time):
+        return False
+    if until_time is None:
+        return None
+    if min([s[1] for s in segments]) > until_time:
+        return False
+    # find the oldest segment that all newer commits are newer than until
+    start = len(segments) - 1
+    while start > 0 and segments[start][1] > until_time:
+        start -= 1
+    if start == len(segments) - 1:
+        return None
+    return segments[start][0]
+
+def select_git_log_lines(lines, since_time, min_nr_mails, max_nr_mails):
+    # lines are of '%ct <git_log_pretty_format>' format, latest first
+    nr_lines = 0
+    for line in lines:
+        fields = line.split(' ', 1)
+        if len(fields) < 2:
+            continue
+        in_range = since_time is None or int(fields[0]) >= since_time
+        if in_range and (max_nr_mails is None or nr_lines < max_nr_mails):
+            pass
+        elif min_nr_mails is not None and nr_lines < min_nr_mails:
+            pass
+        else:
+            break
+        nr_lines += 1
+        yield line
+
+def git_log_timed_lines(mdir, since, until, min_nr_mails, max_nr_mails,
+                        commits_range):
+    if commits_range is None:
+        commits_range = epoch_log_start(mdir, since, until, min_nr_mails)
+        if commits_range is False:
+            return
+    since_time = None
+    if since is not None:
+        since_time = git_date_to_time(mdir, '--since', since)
+    cmd = ['git', '--git-dir=%s' % mdir, 'log', '--date=iso-strict',
+           '--pretty=%%ct %s' % git_log_pretty_format]
+    if commits_range is not None:
+        cmd += [commits_range]
+    if until:
+        cmd += ['--until=%s' % until]
+
+    # maybe commits_range is given, but the commit is not in this mdir.  Then
+    # git fails, and no line is given.
+    for line in select_git_log_lines(_hkml.cmd_lines_stream(cmd), since_time,
+                                     min_nr_mails, max_nr_mails):
+        yield line
+
+def strip_commit_time(line):
+    return line.split(' ', 1)[1]
+
+def git_log_lines(mdir, since, until, min_nr_mails, max_nr_mails,
+                  commits_range):
+    for line in git_log_timed_lines(mdir, since, until, min_nr_mails,
+                                    max_nr_mails, commits_range):
+        yield strip_commit_time(line)
+
+def git_log_new_timed_lines(mdir, since, until, min_nr_mails, max_nr_mails,
+                            head, old_head, old_lines):
+    # read only commits after old_head.  None if the history is rewritten
+    if subprocess.call(['git', '--git-dir=%s' % mdir, 'merge-base',
+                        '--is-ancestor', old_head, head],
+                       stderr=subprocess.DEVNULL) != 0:
+        return None
+    cmd = ['git', '--git-dir=%s' % mdir, 'log', '--date=iso-strict',
+           '--pretty=%%ct %s' % git_log_pretty_format, head, '^%s' % old_head]
+    if until:
+        cmd += ['--until=%s' % until]
+    try:
+        lines = [l for l in _hkml.cmd_lines_output(cmd) if l]
+    except subprocess.CalledProcessError:
+        return None
+    since_time = None
+    if since is not None:
+        since_time = git_date_to_time(mdir, '--since', since)
+    # old_lines are the prefix of the old output that selected by the same
+    # rule, and the new lines only increase the counts.  Hence the selection
+    # ends before the end of old_lines, unless the old one did.
+    return list(select_git_log_lines(lines + old_lines, since_time,
+                                     min_nr_mails, max_nr_mails))
+
+def git_log_lines_to_mails_stream(lines, mdir):
+    chunk_size = 512
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            for mail in git_log_output_lines_to_mails(chunk, mdir):
+                yield mail
+            chunk = []
+    for mail in git_log_output_lines_to_mails(chunk, mdir):
+        yield mail
+
+def fetched_epoch_dirs(mail_list):
+    # latest one first
     mdirs = _hkml.mail_list_data_paths(mail_list, _hkml.get_manifest())
     if not mdirs:
         print("Mailing list '%s' in manifest not found." % mail_list)
         exit(1)
 
-    mails = []
+    fetched = []
     for mdir in mdirs:
-        lines = []
         if not os.path.isdir(mdir):
             break
-        base_cmd = ['git', '--git-dir=%s' % mdir, 'log',
-                '--date=iso-strict', '--pretty=%H %ad %s']
-        if commits_range is not None:
-            base_cmd += [commits_range]
-
-        cmd = base_cmd + []
-
-        if since is not None:
-            cmd += ['--since=%s' % since]
-        if until:
-            cmd += ['--until=%s' % until]
-        if max_nr_mails is not None:
-            cmd += ['-n', max_nr_mails]
-        try:
-            lines = _hkml.cmd_lines_output(cmd)
-        except:
-            # maybe commits_range is given, but the commit is not in this mdir
-            pass
-
-        if min_nr_mails is not None and len(lines) < min_nr_mails:
-            cmd = base_cmd + ['-n', '%d' % min_nr_mails]
-            if until:
-                cmd += ['--until=%s' % until]
-            try:
-                lines = _hkml.cmd_lines_output(cmd)
-            except:
-                # maybe commits_range is given, but the commit is not in this
-                # mdir
-                pass
+        fetched.append(mdir)
+    return fetched
+
+def iter_mails_from_git(mail_list, since, until,
+                        min_nr_mails, max_nr_mails, commits_range=None,
+                        runtime_profile=None):
+    for mdir in fetched_epoch_dirs(mail_list):
+        timestamp = time.time()
+        for mail in git_log_lines_to_mails_stream(
+                git_log_lines(mdir, since, until, min_nr_mails,
+                              max_nr_mails, commits_range), mdir):
+            yield mail
+        if runtime_profile is not None:
+            runtime_profile.append(
+                    ['git_log (%s)' % hkml_index.epoch_path_of(mdir),
+                     time.time() - timestamp])
 
-        for line in lines:
-            mail = git_log_output_line_to_mail(line, mdir)
-            if mail:
-                mails.append(mail)
-    return mails
+def get_mails_from_git(mail_list, since, until,
+                       min_nr_mails, max_nr_mails, commits_range=None,
+                       runtime_profile=None):
+    return list(iter_mails_from_git(mail_list, since, until, min_nr_mails,
+                                    max_nr_mails, commits_range,
+                                    runtime_profile))
+
+def git_log_mails(mdir, after, before, gitids=None):
+    cmd = ['git', '--git-dir=%s' % mdir, 'log', '--date=iso-strict',
+           '--pretty=%s' % git_log_pretty_format]
+    stdin = None
+    if gitids is not None:
+        if not gitids:
+            return []
+        cmd += ['--no-walk', '--stdin']
+        stdin = ('\n'.join(gitids) + '\n').encode()
+    else:
+        if after is not None:
+            cmd.append('--since=%s' % after.strftime('%Y-%m-%d'))
+        if before is not None:
+            cmd.append('--until=%s' % before.strftime('%Y-%m-%d'))
+    output = _hkml.decode_output(
+            subprocess.run(cmd, input=stdin, capture_output=True).stdout)
+    return git_log_output_lines_to_mails(output.split('\n'), mdir)
 
 def is_mailing_list(name):
     manifest = _hkml.get_manifest()
@@ -583,18 +1038,20 @@ def is_mailing_list(name):
             return True
     return False
 
+def source_type_of(source):
+    if source == 'clipboard':
+        return 'clipboard'
+    if os.path.isfile(source):
+        return 'mbox'
+    if is_mailing_list(source):
+        return 'mailing_list'
+    return 'tag'
+
 def get_mails(source, fetch, since, until,
               min_nr_mails, max_nr_mails, commits_range=None,
-              source_type=None):
+              source_type=None, runtime_profile=None):
     if source_type is None:
-        if source == 'clipboard':
-            source_type = 'clipboard'
-        elif os.path.isfile(source):
-            source_type = 'mbox'
-        elif is_mailing_list(source):
-            source_type = 'mailing_list'
-        else:
-            source_type = 'tag'
+        source_type = source_type_of(source)
 
     if source_type == 'clipboard':
         mails, err = _hkml.read_mails_from_clipboard()
@@ -621,20 +1078,155 @@ def get_mails(source, fetch, since, until,
         hkml_fetch.fetch_mail([source], True, 1)
 
     mails = get_mails_from_git(source, since, until, min_nr_mails,
-                               max_nr_mails, commits_range)
+                               max_nr_mails, commits_range, runtime_profile)
     mails.reverse()
     return mails
 
+def epoch_git_log_timed_lines(mdir, since, until, min_nr_mails, max_nr_mails,
+                              start, cached_epoch):
+    # lines are yielded while git is running, unless made from cached_epoch
+    head = hkml_maintain.epoch_head(mdir)
+    lines = None
+    if cached_epoch is not None and head is not None:
+        old_head, old_lines = cached_epoch
+        if old_head == head:
+            lines = old_lines
+        elif old_lines is not None:
+            lines = git_log_new_timed_lines(
+                    mdir, since, until, min_nr_mails, max_nr_mails, head,
+                    old_head, old_lines)
+    if lines is None:
+        if start is None:
+            start = head
+        lines = git_log_timed_lines(mdir, since, until, min_nr_mails,
+                                    max_nr_mails, start)
+    return head, lines
+
+def timed_git_log_lines(mdir, since, until, min_nr_mails, max_nr_mails,
+                        start, cached_epoch):
+    timestamp = time.time()
+    head, lines = epoch_git_log_timed_lines(
+            mdir, since, until, min_nr_mails, max_nr_mails, start,
+            cached_epoch)
+    lines = list(lines)
+    return lines, head, time.time() - timestamp
+
+def epoch_mails_stream(mdir, lines, all_lines):
+    def strip_and_keep(lines):
+        for line in lines:
+            all_lines.append(line)
+            yield strip_commit_time(line)
+    return git_log_lines_to_mails_stream(strip_and_keep(lines), mdir)
+
+def get_mails_of_sources(sources, fetch, since, until, min_nr_mails,
+                         max_nr_mails, source_type=None,
+                         runtime_profile=None, cached_epochs=None,
+                         epochs_state=None):
+    # only new commits of 'cached_epochs' are read from git.  'epochs_state'
+    # receives the epochs for cache_list_str()
+    if cached_epochs is None:
+        cached_epochs = {}
+    source_types = [source_type if source_type is not None
+                    else source_type_of(source) for source in sources]
+    mail_lists = [source for source, type_ in zip(sources, source_types)
+                  if type_ == 'mailing_list']
+    if fetch and mail_lists:
+        hkml_fetch.fetch_mail(mail_lists, True, 1)
+
+    sources_mails = [None] * len(sources)
+    sources_time = [0] * len(sources)
+    epochs_profile = [[] for source in sources]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        tasks = []
+        # the first epoch is read here, constructing the mails while its git
+        # log is running, and others are read concurrently
+        first_task = None
+        for idx, source in enumerate(sources):
+            if source_types[idx] != 'mailing_list':
+                continue
+            for mdir in fetched_epoch_dirs(source):
+                cached_epoch = cached_epochs.get(mdir)
+                start = None
+                if cached_epoch is None:
+                    start = epoch_log_start(mdir, since, until,
+                                            min_nr_mails)
+                    if start is False:
+                        head = hkml_maintain.epoch_head(mdir)
+                        if epochs_state is not None and head is not None:
+                            epochs_state[mdir] = [head, []]
+                        continue
+                if first_task is None:
+                    first_task = [idx, mdir, start, cached_epoch]
+                    continue
+                tasks.append([idx, mdir, executor.submit(
+                    timed_git_log_lines, mdir, since, until, min_nr_mails,
+                    max_nr_mails, start, cached_epoch)])
+
+        if first_task is not None:
+            idx, mdir, start, cached_epoch = first_task
+            timestamp = time.time()
+            head, lines = epoch_git_log_timed_lines(
+                    mdir, since, until, min_nr_mails, max_nr_mails, start,
+                    cached_epoch)
+            all_lines = []
+            sources_mails[idx] = list(epoch_mails_stream(mdir, lines,
+                                                         all_lines))
+            if epochs_state is not None and head is not None:
+                epochs_state[mdir] = [head, all_lines]
+            elapsed = time.time() - timestamp
+            sources_time[idx] += elapsed
+            epochs_profile[idx].append(
+                    ['git_log (%s)' % hkml_index.epoch_path_of(mdir),
+                     elapsed])
+
+        for idx, source in enumerate(sources):
+            if source_types[idx] == 'mailing_list':
+                if sources_mails[idx] is None:
+                    sources_mails[idx] = []
+                continue
+            timestamp = time.time()
+            sources_mails[idx] = get_mails(
+                    source, fetch, since, until, min_nr_mails, max_nr_mails,
+                    source_type=source_types[idx])
+            sources_time[idx] += time.time() - timestamp
+
+        for idx, mdir, future in tasks:
+            lines, head, git_log_time = future.result()
+            if epochs_state is not None and head is not None:
+                epochs_state[mdir] = [head, lines]
+            timestamp = time.time()
+            sources_mails[idx] += git_log_lines_to_mails_stream(
+                    [strip_commit_time(line) for line in lines], mdir)
+            sources_time[idx] += git_log_time + time.time() - timestamp
+            epochs_profile[idx].append(
+                    ['git_log (%s)' % hkml_index.epoch_path_of(mdir),
+                     git_log_time])
+
+    for idx, source in enumerate(sources):
+        if source_types[idx] == 'mailing_list':
+            sources_mails[idx].reverse()
+        if runtime_profile is not None:
+            runtime_profile.append([source, sources_time[idx]])
+            runtime_profile += [['  %s' % key, value]
+                                for key, value in epochs_profile[idx]]
+    if len(sources) == 1:
+        return sources_mails[0]
+    for mails in sources_mails:
+        mails.sort(key=lambda mail: mail.date)
+    # ties are broken by the order of the sources
+    return list(heapq.merge(*sources_mails, key=lambda mail: mail.date))
+
 def last_listed_mails():
-    cache = get_list_output_cache()
-    last_key = sorted(cache.keys(), key=lambda x: cache[x]['date'])[-1]
-    idx_to_keys = cache[last_key]['index_to_cache_key']
+    key = last_list_output_key()
+    if key is None:
+        return []
     mails = []
-    for idx in sorted([int(idx) for idx in idx_to_keys.keys()]):
-        cache_key = idx_to_keys['%d' % idx]
+    for idx, cache_key in get_list_outputs_db().execute(
+            '''SELECT idx, cache_key FROM list_output_indexes WHERE key = ?
+                ORDER BY idx''', (key,)):
         mail = hkml_cache.get_mail(key=cache_key)
         if mail is not None:
-            mail.pridx = int(idx)
+            mail.pridx = idx
             mails.append(mail)
     return mails
 
@@ -719,12 +1311,39 @@ def set_argparser(parser=None):
     add_mails_filter_arguments(parser)
     add_decoration_arguments(parser)
 
+    parser.add_argument('--thread_summary', action='store_true',
+            help=' '.join([
+                'list threads having mails in the time range, using the',
+                'thread summaries of the index.  Numbers of replies of the',
+                'whole threads are shown.']))
+
     # misc
     parser.add_argument('--fetch', action='store_true',
             help='fetch mails before listing')
+    parser.add_argument('--background_fetch', action='store_true',
+            help=' '.join(['show the cached output first, and fetch mails',
+                           'and list again in background']))
+    # for the background worker of --background_fetch.  Receives the pid of
+    # the command that started the worker.
+    parser.add_argument('--background_worker', metavar='<pid>', type=int,
+            help=argparse.SUPPRESS)
     parser.add_argument('--stdout', action='store_true',
             help='print to stdout instead of using the pager')
 
+def start_background_worker():
+    # the terminal is kept as stdout, for the same output width
+    subprocess.Popen([sys.executable] + sys.argv +
+                     ['--background_worker', '%d' % os.getpid()],
+                     stdin=subprocess.DEVNULL, start_new_session=True)
+
+def notify_background_listing_done(args):
+    # don't disturb the pager of the command that started this worker
+    while os.getppid() == args.background_worker:
+        time.sleep(0.1)
+    sys.stderr.write('# newer output of \'hkml %s\' is ready\n' %
+                     ' '.join([arg for arg in sys.argv[1:-2]
+                               if arg != '--background_fetch']))
+
 def main(args=None):
     if not args:
         parser = argparse.ArgumentParser()
@@ -732,6 +1351,23 @@ def main(args=None):
         args = parser.parse_args()
 
     list_output_cache_key = args_to_list_output_key(args)
+    if (args.background_fetch and args.background_worker is None and
+            args.sources):
+        to_show = get_list_str(list_output_cache_key)
+        if to_show is not None:
+            start_background_worker()
+            to_show = '\n'.join(['# (fetching in background)', to_show])
+            if args.stdout:
+                print(to_show)
+            else:
+                hkml_open.pr_with_pager_if_needed(to_show)
+            return
+        # nothing to show first
+        args.fetch = True
+    if args.background_worker is not None:
+        args.fetch = True
+
+    cached_epochs = None
     if args.fetch == False or args.sources == []:
         if args.sources == []:
             to_show = get_last_list_str()
@@ -739,17 +1375,20 @@ def main(args=None):
                 print('no valid last list output exists')
                 exit(1)
         else:
-            to_show = get_list_str(list_output_cache_key)
+            cached_epochs = get_cached_list_output_epochs(
+                    list_output_cache_key)
+            if list_output_outdated(cached_epochs):
+                to_show = None
+            else:
+                to_show = get_list_str(list_output_cache_key)
         if to_show is not None:
             if args.stdout:
                 print(to_show)
             else:
                 hkml_open.pr_with_pager_if_needed(to_show)
-            writeback_list_output()
             return
     else:
-        for source in args.sources:
-            invalidate_cached_outputs(source)
+        cached_epochs = get_cached_list_output_epochs(list_output_cache_key)
 
     if args.nr_mails is not None:
         args.since = (datetime.datetime.strptime(args.until, '%Y-%m-%d') -
@@ -763,32 +1402,80 @@ def main(args=None):
         except OSError as e:
             pass
 
+    if args.thread_summary:
+        if args.fetch:
+            hkml_fetch.fetch_mail(args.sources, True, 1)
+        epochs = mail_lists_epochs_heads(
+                [s for s in args.sources if is_mailing_list(s)])
+        to_show = thread_summaries_to_str(
+                args.sources, args.since, args.until,
+                MailListDecorator(args))
+        hkml_cache.writeback_mails()
+        cache_list_str(list_output_cache_key, to_show, epochs)
+        if args.background_worker is not None:
+            notify_background_listing_done(args)
+            return
+        if args.stdout:
+            print(to_show)
+            return
+        hkml_open.pr_with_pager_if_needed(to_show)
+        return
+
     timestamp = time.time()
-    runtime_profile = []
+    sources_profile = []
     mails_to_show = []
     msgids = {}
-    for source in args.sources:
-        for mail in get_mails(
-                source, args.fetch, args.since, args.until,
-                args.min_nr_mails, args.max_nr_mails, None,
-                source_type=args.source_type):
-            msgid = mail.get_field('message-id')
-            if not msgid in msgids:
-                mails_to_show.append(mail)
-            msgids[mail.get_field('message-id')] = True
+    epochs = {}
+    for mail in get_mails_of_sources(
+            args.sources, args.fetch, args.since, args.until,
+            args.min_nr_mails, args.max_nr_mails,
+            source_type=args.source_type, runtime_profile=sources_profile,
+            cached_epochs=cached_epochs, epochs_state=epochs):
+        msgid = mail.get_field('message-id')
+        if not msgid in msgids:
+            mails_to_show.append(mail)
+        msgids[mail.get_field('message-id')] = True
     runtime_profile = [['get_mails', time.time() - timestamp]]
+    # time for each source is a part of get_mails
+    runtime_profile += [['  %s' % key, value]
+                        for key, value in sources_profile]
     if args.max_nr_mails is not None:
         mails_to_show = mails_to_show[:args.max_nr_mails]
 
-    to_show = mails_to_str(mails_to_show, MailListFilter(args),
+    lines = mails_to_lines(mails_to_show, MailListFilter(args),
                            MailListDecorator(args), None, runtime_profile)
-    hkml_cache.writeback_mails()
-    cache_list_str(list_output_cache_key, to_show)
+    cache_output = lambda to_show: cache_list_output(
+            list_output_cache_key, to_show, epochs)
 
+    if args.background_worker is not None:
+        cache_output('\n'.join(lines))
+        notify_background_listing_done(args)
+        return
     if args.stdout:
-        print(to_show)
+        all_lines = []
+        stdout_closed = False
+        for line in lines:
+            all_lines.append(line)
+            if stdout_closed:
+                continue
+            try:
+                print(line)
+            except BrokenPipeError:
+                # e.g., piped to 'head'.  Still receive the lines to cache.
+                stdout_closed = True
+        if not stdout_closed:
+            try:
+                sys.stdout.flush()
+            except BrokenPipeError:
+                stdout_closed = True
+        if stdout_closed:
+            # avoid another BrokenPipeError from flush at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        cache_output('\n'.join(all_lines))
         return
-    hkml_open.pr_with_pager_if_needed(to_show)
+    # cache the output before the pager is closed, for 'hkml open' from
+    # another terminal
+    hkml_open.pr_lines_with_pager_if_needed(lines, cache_output)
 
 if __name__ == '__main__':
     main()
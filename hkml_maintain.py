@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0
+
+import argparse
+import json
+import os
+import subprocess
+
+import _hkml
+import hkml_index
+
+'''
+Maintenance of the fetched mailing list archive git repositories.
+
+'git log --since/--until' that 'hkml list' runs for each epoch walks the
+history of the epoch.  Commit-graph files make the walk cheap by letting git
+read commit dates and generation numbers without parsing commit objects, and
+reachability bitmaps make counting and serving the objects cheap.  'hkml
+fetch' adds incremental commit-graph layers for the newly fetched commits,
+and 'hkml maintain' fully repacks the repositories with the bitmaps and
+rewrites the commit-graph.
+
+The date index, which is saved in a json file called 'epochs_date_index' under
+the hkml directory, further helps 'hkml list' avoid the walks.  Keys are the
+paths of the epochs under 'archives' directory, and values are the head commit
+of the epoch at the indexing, the number of the commits, and the segments of
+the history.  Each segment is 'date_index_interval' commits, and saved as its
+last commit and the oldest and the newest commit dates of the commits in the
+segment, oldest segment first.  'hkml list' skips epochs having no mail in the
+dates range, and starts 'git log' from the last commit of the oldest segment
+that all newer commits are not older than '--until'.  'hkml fetch' updates the
+index for the fetched epochs, and 'hkml maintain' for all epochs.  The index
+of an epoch that updated without the update of the index is not used.
+'''
+
+def is_shallow(mdir):
+    return os.path.isfile(os.path.join(mdir, 'shallow'))
+
+def write_commit_graph(mdir, incremental=False):
+    cmd = ['git', '--git-dir=%s' % mdir, 'commit-graph', 'write',
+           '--reachable']
+    if incremental:
+        cmd += ['--split']
+    else:
+        cmd += ['--split=replace']
+    return subprocess.call(cmd, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+
+def repack(mdir):
+    cmd = ['git', '--git-dir=%s' % mdir, 'repack', '-a', '-d', '-q']
+    # bitmaps cannot cover the objects that are not in the repository
+    if not is_shallow(mdir) and not _hkml.is_partial_clone(mdir):
+        cmd += ['--write-bitmap-index']
+    return subprocess.call(cmd)
+
+date_index_interval = 1024
+date_index = None
+
+def date_index_path():
+    return os.path.join(_hkml.get_hkml_dir(), 'epochs_date_index')
+
+def get_date_index():
+    global date_index
+
+    if date_index is None:
+        date_index = {}
+        if os.path.isfile(date_index_path()):
+            with open(date_index_path(), 'r') as f:
+                date_index = json.load(f)
+    return date_index
+
+def writeback_date_index():
+    if date_index is None:
+        return
+    with open(date_index_path(), 'w') as f:
+        json.dump(date_index, f)
+
+def epoch_head(mdir):
+    # None if it cannot be read without running git
+    try:
+        with open(os.path.join(mdir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head
+        ref = head[len('ref: '):]
+        ref_path = os.path.join(mdir, ref)
+        if os.path.isfile(ref_path):
+            with open(ref_path, 'r') as f:
+                return f.read().strip()
+        with open(os.path.join(mdir, 'packed-refs'), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except OSError:
+        pass
+    return None
+
+def update_date_index(mdir):
+    # caller should call writeback_date_index() after updates
+    epoch_path = hkml_index.epoch_path_of(mdir)
+    index = get_date_index()
+    entry = index.get(epoch_path)
+    # objects of the rewritten history may still exist
+    if entry is not None and subprocess.call(
+            ['git', '--git-dir=%s' % mdir, 'merge-base', '--is-ancestor',
+             entry['head'], 'HEAD'], stderr=subprocess.DEVNULL) != 0:
+        # the history has rewritten.  Index from the scratch.
+        entry = None
+    cmd = ['git', '--git-dir=%s' % mdir, 'log', '--reverse',
+           '--pretty=%H %ct', 'HEAD']
+    if entry is not None:
+        cmd.append('^%s' % entry['head'])
+    try:
+        lines = _hkml.cmd_lines_output(cmd)
+    except subprocess.CalledProcessError:
+        index.pop(epoch_path, None)
+        return
+    if entry is None:
+        entry = {'head': None, 'nr_commits': 0, 'segments': []}
+
+    segments = entry['segments']
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 2:
+            continue
+        gitid, date = fields[0], int(fields[1])
+        if entry['nr_commits'] % date_index_interval == 0:
+            segments.append([gitid, date, date])
+        segment = segments[-1]
+        segment[0] = gitid
+        segment[1] = min(segment[1], date)
+        segment[2] = max(segment[2], date)
+        entry['nr_commits'] += 1
+        entry['head'] = gitid
+    if entry['head'] is not None:
+        index[epoch_path] = entry
+
+def epoch_date_segments(mdir):
+    # None if the epoch is updated after the indexing
+    entry = get_date_index().get(hkml_index.epoch_path_of(mdir))
+    if entry is None or entry['head'] != epoch_head(mdir):
+        return None
+    return entry['segments']
+
+def maintain_epoch(mdir, quiet=False):
+    epoch_path = hkml_index.epoch_path_of(mdir)
+    if not quiet:
+        print('maintaining %s' % epoch_path)
+    if repack(mdir) != 0:
+        print('repacking %s failed' % epoch_path)
+        return
+    if write_commit_graph(mdir) != 0:
+        print('writing commit-graph of %s failed' % epoch_path)
+    update_date_index(mdir)
+
+def set_argparser(parser):
+    parser.description = 'maintain fetched mails archive'
+    parser.add_argument('mlist', metavar='<mailing list>', nargs='*',
+            help='mailing list to maintain.  All fetched lists by default')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+            help='Work silently.')
+
+def main(args=None):
+    if not args:
+        parser = argparse.ArgumentParser()
+        set_argparser(parser)
+        args = parser.parse_args()
+
+    mail_lists = args.mlist
+    if not mail_lists:
+        archives_dir = hkml_index.archives_dir()
+        mail_lists = [d for d in os.listdir(archives_dir)
+                      if os.path.isdir(os.path.join(archives_dir, d))]
+    for mdir in hkml_index.epoch_dirs(mail_lists):
+        maintain_epoch(mdir, args.quiet)
+    writeback_date_index()
+
+if __name__ == '__main__':
+    main()
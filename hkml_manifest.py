@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: GPL-2.0
 
 import argparse
+import gzip
 import json
 
 import _hkml
@@ -18,6 +19,20 @@ def set_argparser(parser):
     parser.add_argument('--site', metavar='<url>',
             help='site to fetch mail archives')
 
+def convert_public_inbox_manifest(manifest, site):
+    manifest['site'] = site
+    return manifest
+
+def fetch_public_inbox_manifest(site):
+    '''Download the grokmirror manifest of the public inbox site, and returns
+    it in hackermail manifest format'''
+    # importing urllib.request takes time.  Do it only when really needed.
+    import urllib.request
+
+    with urllib.request.urlopen('%s/manifest.js.gz' % site) as f:
+        manifest = json.loads(gzip.decompress(f.read()))
+    return convert_public_inbox_manifest(manifest, site)
+
 def need_to_print(key, depth, mlists):
     if depth > 0:
         return True
@@ -62,8 +77,7 @@ def main(args=None):
             exit(1)
         with open(args.public_inbox_manifest) as f:
             manifest = json.load(f)
-        manifest['site'] = args.site
-        print(json.dumps(manifest))
+        print(json.dumps(convert_public_inbox_manifest(manifest, args.site)))
 
 if __name__ == '__main__':
     main()
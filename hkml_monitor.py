@@ -156,6 +156,7 @@ def get_mails_to_check(request, ignore_mails_before, last_monitored_mails):
 def get_mails_to_noti(mails_to_check, request):
     mails_to_noti = []
 
+    mails_to_check = request.mail_list_filter.filter_candidates(mails_to_check)
     for mail in mails_to_check:
         if request.mail_list_filter.should_filter_out(mail):
             continue
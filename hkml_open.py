@@ -23,6 +23,55 @@ def pr_with_pager_if_needed(text):
     subprocess.call(['less', '-M', '--no-init', tmp_path])
     os.remove(tmp_path)
 
+def pr_lines_with_pager_if_needed(lines, lines_done=None):
+    '''Same to pr_with_pager_if_needed(), but receives an iterable of lines,
+    and starts showing those via a pipe to the pager as soon as the lines
+    are more than the terminal can show.  Returns the text of all the lines.
+    If 'lines_done' is given, it is called with the text after all the lines
+    are received, before waiting for the pager to be closed.'''
+    try:
+        nr_rows = os.get_terminal_size().lines
+    except OSError as e:
+        # maybe the user is using pipe to the output
+        nr_rows = None
+
+    all_lines = []
+    pager = None
+    pager_input = None
+    for line in lines:
+        all_lines.append(line)
+        if pager is None:
+            if nr_rows is None or len(all_lines) <= nr_rows:
+                continue
+            # line buffered, to show lines as soon as those are made
+            pager = subprocess.Popen(['less', '-M', '--no-init'],
+                                     stdin=subprocess.PIPE, text=True,
+                                     bufsize=1)
+            pager_input = pager.stdin
+            to_write = '\n'.join(all_lines) + '\n'
+        else:
+            to_write = line + '\n'
+        if pager_input is None:
+            continue
+        try:
+            pager_input.write(to_write)
+        except BrokenPipeError:
+            # the user quit the pager.  Still receive the lines.
+            pager_input = None
+
+    text = '\n'.join(all_lines)
+    if pager is None:
+        print(text)
+    if lines_done is not None:
+        lines_done(text)
+    if pager is not None:
+        try:
+            pager.stdin.close()
+        except BrokenPipeError:
+            pass
+        pager.wait()
+    return text
+
 def mail_display_str_via_lore(mail_url):
     lines = []
     try:
@@ -4,6 +4,7 @@ import os
 import subprocess
 import tempfile
 
+import _hkml
 import hkml_list
 import hkml_open
 
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0
+
+import argparse
+import datetime
+import os
+import subprocess
+import time
+
+import _hkml
+import hkml_cache
+import hkml_index
+import hkml_list
+import hkml_open
+import hkml_tag
+
+'''
+Search mails in the fetched mailing lists.
+
+Query is a list of terms that all should be satisfied.  Each term is
+'<field>:<value>' or just a text.  Supported fields are as below.
+
+- from, to, cc, subject: the field contains the value.
+- after, before: the mail is sent after or before the date (YYYY-MM-DD).
+- list: the mail is in the mailing list.  If multiple ones are given, any.
+- tag: the mail is tagged with the tag via 'hkml tag'.
+
+Texts should be in the subject or the body of the mail.  All comparisons of
+the texts ignore cases.
+
+For each epoch, the planner uses the inverted indexes of 'hkml index' to find
+candidate mails, starting from the most selective one.  If no index can be
+used, e.g., the epoch is not indexed, or the query has only dates, mails of
+the epoch in the dates range are scanned.
+'''
+
+query_fields = ['from', 'to', 'cc', 'subject', 'after', 'before', 'list',
+                'tag']
+
+class SearchQuery:
+    # dict of field: list of values, for from, to, cc and subject
+    field_keywords = None
+    texts = None
+    after = None
+    before = None
+    mail_lists = None
+    tags = None
+
+    def __init__(self, terms):
+        self.field_keywords = {}
+        self.texts = []
+        self.mail_lists = []
+        self.tags = []
+        for term in terms:
+            field, _, value = term.partition(':')
+            if not field in query_fields or value == '':
+                self.texts.append(term.lower())
+            elif field in hkml_index.indexed_fields:
+                if not field in self.field_keywords:
+                    self.field_keywords[field] = []
+                self.field_keywords[field].append(value.lower())
+            elif field in ['after', 'before']:
+                try:
+                    date = datetime.datetime.strptime(
+                            value, '%Y-%m-%d').astimezone()
+                except ValueError:
+                    print('wrong date (%s)' % term)
+                    exit(1)
+                setattr(self, field, date)
+            elif field == 'list':
+                self.mail_lists.append(value)
+            elif field == 'tag':
+                self.tags.append(value)
+
+    def index_probes(self):
+        # [field, token pattern] pairs.  'field' is None for texts
+        probes = []
+        for field, keywords in self.field_keywords.items():
+            for keyword in keywords:
+                probes += [[field, pattern] for pattern in
+                           hkml_index.keyword_token_patterns(keyword)]
+        for text in self.texts:
+            # the text index is case-sensitive
+            probes += [[None, pattern if '%' in pattern else '%s%%' % pattern]
+                       for pattern in hkml_index.keyword_token_patterns(text)]
+        return probes
+
+    def matches(self, mail):
+        if mail.date is None:
+            return False
+        if self.after is not None and mail.date < self.after:
+            return False
+        if self.before is not None and mail.date >= self.before:
+            return False
+        for field, keywords in self.field_keywords.items():
+            value = mail.get_field(field)
+            if value is None:
+                return False
+            if not hkml_list.keywords_in(keywords, value.lower()):
+                return False
+        if self.texts:
+            text = '%s\n%s' % (mail.subject, mail.get_field('body'))
+            if not hkml_list.keywords_in(self.texts, text.lower()):
+                return False
+        return True
+
+def indexed_candidates(db, epoch_id, probes):
+    # probes from the most selective one
+    probes = sorted(probes, key=lambda probe:
+                    hkml_index.nr_mails_having_tokens(
+                        db, epoch_id, probe[1], probe[0]))
+    candidates = None
+    for field, pattern in probes:
+        mail_ids = hkml_index.mail_ids_having_tokens(
+                db, epoch_id, pattern, field)
+        if candidates is None:
+            candidates = mail_ids
+        else:
+            candidates &= mail_ids
+        # checking a few mails is cheaper than looking up more
+        if len(candidates) <= 64:
+            break
+    return hkml_index.gitids_of_mail_ids(db, candidates)
+
+def epoch_candidates(mdir, query, probes, runtime_profile):
+    timestamp = time.time()
+    db = hkml_index.get_index_db()
+    epoch_id = None
+    if db is not None:
+        epoch_id = hkml_index.get_epoch_id(db, mdir)
+    if epoch_id is None or not probes:
+        mails = hkml_list.git_log_mails(mdir, query.after, query.before)
+        plan = 'scan'
+    else:
+        gitids = indexed_candidates(db, epoch_id, probes)
+        mails = hkml_list.git_log_mails(mdir, None, None, list(gitids))
+        # mails that fetched after the indexing are not in the index
+        last_commit = db.execute(
+                'SELECT last_commit FROM epochs WHERE id = ?',
+                (epoch_id,)).fetchone()[0]
+        if last_commit is not None:
+            mails += git_log_mails_after(mdir, last_commit)
+        plan = 'index'
+    runtime_profile.append(
+            ['  %s (%s)' % (hkml_index.epoch_path_of(mdir), plan),
+             time.time() - timestamp])
+    return mails
+
+def git_log_mails_after(mdir, last_commit):
+    cmd = ['git', '--git-dir=%s' % mdir, 'log', '--date=iso-strict',
+           '--pretty=%s' % hkml_list.git_log_pretty_format, 'HEAD',
+           '^%s' % last_commit]
+    try:
+        lines = _hkml.cmd_lines_output(cmd)
+    except subprocess.CalledProcessError:
+        return []
+    return hkml_list.git_log_output_lines_to_mails(lines, mdir)
+
+def in_epochs(mail, mdirs):
+    return mail.gitdir is not None and \
+            os.path.abspath(mail.gitdir) in mdirs
+
+def search_mails(query, runtime_profile):
+    mail_lists = query.mail_lists
+    if not mail_lists:
+        archives_dir = hkml_index.archives_dir()
+        mail_lists = [d for d in os.listdir(archives_dir)
+                      if os.path.isdir(os.path.join(archives_dir, d))]
+    mdirs = hkml_index.epoch_dirs(mail_lists)
+
+    timestamp = time.time()
+    if query.tags:
+        # tagged mails are usually only a few.  Just check all of those.
+        candidates = None
+        for tag in query.tags:
+            tagged = hkml_tag.mails_of_tag(tag)
+            if candidates is None:
+                candidates = tagged
+                continue
+            msgids = {m.get_field('message-id'): True for m in tagged}
+            candidates = [m for m in candidates
+                          if m.get_field('message-id') in msgids]
+        if query.mail_lists:
+            abs_mdirs = [os.path.abspath(mdir) for mdir in mdirs]
+            candidates = [m for m in candidates if in_epochs(m, abs_mdirs)]
+        runtime_profile.append(['get_candidates', time.time() - timestamp])
+    else:
+        candidates = []
+        probes = query.index_probes()
+        epochs_profile = []
+        for mdir in mdirs:
+            candidates += epoch_candidates(mdir, query, probes,
+                                           epochs_profile)
+        runtime_profile.append(['get_candidates', time.time() - timestamp])
+        runtime_profile += epochs_profile
+
+    timestamp = time.time()
+    if query.texts:
+        _hkml.fill_mboxes(candidates)
+    mails = []
+    msgids = {}
+    for mail in candidates:
+        if not query.matches(mail):
+            continue
+        msgid = mail.get_field('message-id')
+        if msgid in msgids:
+            continue
+        msgids[msgid] = True
+        mails.append(mail)
+    runtime_profile.append(['check_candidates', time.time() - timestamp])
+    return mails
+
+def set_argparser(parser):
+    parser.description = 'search mails'
+    _hkml.set_manifest_option(parser)
+    parser.add_argument('query', metavar='<term>', nargs='+',
+            help=' '.join([
+                'Search query term.  \'<field>:<value>\' or a text.',
+                'Fields are %s.' % ', '.join(query_fields),
+                'Texts are searched from subject and body.']))
+    hkml_list.add_decoration_arguments(parser)
+    parser.add_argument('--stdout', action='store_true',
+            help='print to stdout instead of using the pager')
+
+def main(args=None):
+    if not args:
+        parser = argparse.ArgumentParser()
+        set_argparser(parser)
+        args = parser.parse_args()
+
+    if args.cols is None:
+        try:
+            args.cols = int(os.get_terminal_size().columns * 9 / 10)
+        except OSError as e:
+            pass
+
+    runtime_profile = []
+    mails = search_mails(SearchQuery(args.query), runtime_profile)
+    to_show = hkml_list.mails_to_str(
+            mails, None, hkml_list.MailListDecorator(args), None,
+            runtime_profile)
+    hkml_cache.writeback_mails()
+    # let 'open', 'reply', etc. find the mails by the index
+    hkml_list.cache_list_str(hkml_list.args_to_list_output_key(args), to_show)
+
+    if args.stdout:
+        print(to_show)
+        return
+    hkml_open.pr_with_pager_if_needed(to_show)
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ import tempfile
 
 import _hkml
 import hkml_cache
+import hkml_index
 import hkml_list
 import hkml_open
 
@@ -25,6 +26,18 @@ def set_argparser(parser=None):
             '--dont_use_b4', action='store_true',
             help='don\'t use b4 but only previous list\'s output')
 
+def get_thread_mails_from_index(msgid):
+    '''Returns mails of the thread in the fetched and indexed mailing lists,
+    or None if the mail is not indexed'''
+    msgids = hkml_index.thread_msgids(msgid)
+    if msgids is None:
+        return None
+    mails = []
+    for mdir, gitids in hkml_index.locate_mails(msgids).items():
+        mails += hkml_list.git_log_mails(mdir, None, None, gitids)
+    mails.sort(key=lambda mail: mail.date)
+    return mails
+
 def get_thread_mails_use_b4(msgid):
     fd, tmp_path = tempfile.mkstemp(prefix='hkml_thread_')
     if subprocess.call(['b4', 'mbox', '--mbox-name', tmp_path, msgid],
@@ -46,24 +59,29 @@ def main(args=None):
         hkml_open.pr_with_pager_if_needed(to_show)
         return
 
-    if subprocess.call(['which', 'b4'], stdout=subprocess.DEVNULL) == 0:
-        use_b4 = args.dont_use_b4 is False
-
-    if use_b4:
-        mail = hkml_list.get_mail(args.mail_idx, not_thread_idx=True)
-        if mail is None:
-            print('wrong <mail_idx>')
-            exit(1)
-        msgid = mail.get_field('message-id')
-
-        mails_to_show, err = get_thread_mails_use_b4(msgid)
-        if err is not None:
-            print(err)
-            exit(1)
+    mail = hkml_list.get_mail(args.mail_idx, not_thread_idx=True)
+    if mail is None:
+        print('wrong <mail_idx>')
+        exit(1)
+    msgid = mail.get_field('message-id')
 
+    # the whole thread is available from the index, or b4
+    whole_thread = True
+    mails_to_show = get_thread_mails_from_index(msgid)
+    if mails_to_show is None:
+        use_b4 = False
+        if subprocess.call(['which', 'b4'], stdout=subprocess.DEVNULL) == 0:
+            use_b4 = args.dont_use_b4 is False
+        if use_b4:
+            mails_to_show, err = get_thread_mails_use_b4(msgid)
+            if err is not None:
+                print(err)
+                exit(1)
+        else:
+            whole_thread = False
+            mails_to_show = hkml_list.last_listed_mails()
+    if whole_thread:
         args.mail_idx = None
-    else:
-        mails_to_show = hkml_list.last_listed_mails()
 
     nr_cols_in_line = int(os.get_terminal_size().columns * 9 / 10)
     list_decorator = hkml_list.MailListDecorator(None)
@@ -79,7 +97,7 @@ def main(args=None):
             mails_to_show, mails_filter=None, list_decorator=list_decorator,
             show_thread_of=args.mail_idx, runtime_profile=[])
 
-    if use_b4:
+    if whole_thread:
         hkml_cache.writeback_mails()
         hkml_list.cache_list_str('thread_output', to_show)
     hkml_open.pr_with_pager_if_needed(to_show)
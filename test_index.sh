@@ -0,0 +1,105 @@
+#!/bin/bash
+# Check that re-indexing a rewritten mails archive history removes the thread
+# links and summaries of the mails that no more exist, and rebuilds the date
+# index of the epoch.
+
+HKML=$(realpath ./hkml)
+TEST_DIR=$(mktemp -d)
+trap 'rm -rf "$TEST_DIR"' EXIT
+
+HKML_DIR=$TEST_DIR/.hkm
+ARCHIVE=$HKML_DIR/archives/tlist/git/0.git
+WORK=$TEST_DIR/work
+
+git init -q --bare "$ARCHIVE" || exit 1
+git init -q "$WORK" || exit 1
+echo '{}' > "$HKML_DIR/manifest"
+
+commit_mail()
+{
+	msgid=$1
+	parent=$2
+	subject=$3
+	{
+		echo "From: Tester <tester@example.org>"
+		echo "Date: Mon, 1 Jan 2024 00:0$4:00 +0000"
+		echo "Message-Id: $msgid"
+		if [ -n "$parent" ]
+		then
+			echo "In-Reply-To: $parent"
+			echo "References: $parent"
+		fi
+		echo "Subject: $subject"
+		echo
+		echo "body"
+	} > "$WORK/m"
+	git -C "$WORK" add m
+	GIT_AUTHOR_DATE="2024-01-01T00:0$4:00+00:00" \
+		GIT_COMMITTER_DATE="2024-01-01T00:0$4:00+00:00" \
+		git -C "$WORK" -c user.name=Tester \
+		-c user.email=tester@example.org commit -q -m "$subject" || exit 1
+}
+
+update_date_index()
+{
+	python3 -c 'import sys
+sys.path.insert(0, sys.argv[1])
+import _hkml, hkml_maintain
+_hkml.set_hkml_dir(sys.argv[2])
+hkml_maintain.update_date_index(sys.argv[3])
+hkml_maintain.writeback_date_index()
+entry = hkml_maintain.get_date_index()["tlist/git/0.git"]
+print(entry["nr_commits"], entry["head"])' \
+		"$(dirname "$HKML")" "$HKML_DIR" "$ARCHIVE"
+}
+
+query()
+{
+	python3 -c 'import sqlite3, sys
+db = sqlite3.connect(sys.argv[1])
+for row in db.execute(sys.argv[2]):
+    print(" ".join([str(x) for x in row]))' "$HKML_DIR/mails_index.db" "$1"
+}
+
+commit_mail '<a@test>' '' 'a' 1
+commit_mail '<b@test>' '<a@test>' 'Re: a' 2
+commit_mail '<c@test>' '<b@test>' 'Re: a' 3
+git -C "$WORK" push -q "$ARCHIVE" HEAD:master || exit 1
+$HKML --hkml_dir "$HKML_DIR" index --quiet tlist || exit 1
+update_date_index > /dev/null || exit 1
+
+if [ "$(query 'SELECT nr_replies FROM thread_summaries')" != "2" ]
+then
+	echo "thread is not indexed"
+	exit 1
+fi
+
+# rewrite the history to have only the first mail and a new mail
+git -C "$WORK" reset -q --hard HEAD~2 || exit 1
+commit_mail '<d@test>' '' 'd' 4
+git -C "$WORK" push -q -f "$ARCHIVE" HEAD:master || exit 1
+$HKML --hkml_dir "$HKML_DIR" index --quiet tlist || exit 1
+
+links=$(query 'SELECT parent, child FROM thread_links')
+if [ -n "$links" ]
+then
+	echo "links of removed mails remain: $links"
+	exit 1
+fi
+summaries=$(query 'SELECT root, nr_replies FROM thread_summaries
+	ORDER BY root')
+if [ "$summaries" != "$(printf '<a@test> 0\n<d@test> 0')" ]
+then
+	echo "wrong thread summaries: $summaries"
+	exit 1
+fi
+
+date_index=$(update_date_index)
+expected="2 $(git -C "$WORK" rev-parse HEAD)"
+if [ "$date_index" != "$expected" ]
+then
+	echo "wrong date index: $date_index (expected $expected)"
+	exit 1
+fi
+
+echo "SUCCESS"